@@ -1,37 +1,699 @@
 import streamlit as st
+import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.scriptrunner.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
 import requests
 import json
+import logging
 import os
 import time
 from datetime import datetime
 from dotenv import load_dotenv
 from memobase import MemoBaseClient, ChatBlob
+from memobase.error import ServerError
+import httpx
 import uuid
 import hashlib
+import re
+import queue
+import shutil
+import socket
+import sqlite3
+import sys
+import zlib
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl - the spools of dead processes are then not recovered
+    fcntl = None
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ReadTimeoutError
+from semantic_cache import SemanticCache, create_embedder
 
 # Load environment variables from .env.local (local development)
 load_dotenv('.env.local')
 
+class MetricsRegistry:
+    """Latency histograms and counters shared by all sessions
+
+    Durations are recorded per pipeline stage and rendered in the Prometheus
+    text exposition format. When a tracer is given (OpenTelemetry), every
+    timed stage is also recorded as a trace span. Components that keep their
+    own counters (caches, the traffic governor, the LLM backend) add a
+    collector that is read on every render.
+    """
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    def __init__(self, tracer=None):
+        self.tracer = tracer
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._counters = {}  # (name, labels) -> value
+        self._collectors = {}  # name -> callable returning (metric, type, labels, value) samples
+    
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+    
+    def add_collector(self, name, collect):
+        """Render the samples collect() returns on every scrape; adding a name again replaces it"""
+        with self._lock:
+            self._collectors[name] = collect
+    
+    def observe_stage(self, stage, seconds):
+        """Record how long one stage of a request took"""
+        self.observe("cognitype_stage_seconds", seconds, stage=stage)
+    
+    @contextmanager
+    def timer(self, stage):
+        """Time the wrapped block as a stage (and a trace span when tracing is on)"""
+        span = self.tracer.start_as_current_span(f"cognitype.{stage}") if self.tracer else nullcontext()
+        started = time.perf_counter()
+        try:
+            with span:
+                yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+    
+    def render(self):
+        """Prometheus text exposition of every metric recorded so far"""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+        
+        with self._lock:
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items())
+            counters = sorted(self._counters.items())
+            collectors = list(self._collectors.values())
+        
+        samples = []
+        for collect in collectors:
+            try:
+                samples.extend(collect())
+            except Exception:
+                # One broken collector must not take the whole endpoint down
+                pass
+        
+        lines = []
+        for name in sorted({name for (name, labels), value in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in counters:
+                if metric == name:
+                    lines.append(f"{name}{label_text(labels)} {value}")
+        for name in sorted({name for (name, labels), value in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), (buckets, total, count) in histograms:
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(self.BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {bucket_count}")
+                lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{label_text(labels)} {total:.6f}")
+                lines.append(f"{name}_count{label_text(labels)} {count}")
+        types = {}
+        for name, metric_type, labels, value in samples:
+            types.setdefault(name, metric_type)
+        for name, metric_type in types.items():
+            lines.append(f"# TYPE {name} {metric_type}")
+            for metric, _, labels, value in samples:
+                if metric == name:
+                    lines.append(f"{name}{label_text(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+def get_tracer():
+    """OpenTelemetry tracer when tracing is enabled (needs the optional opentelemetry-api package)"""
+    if not OTEL_TRACING:
+        return None
+    try:
+        from opentelemetry import trace
+        return trace.get_tracer("cognitype_chatbot")
+    except Exception:
+        return None
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """Serve the Prometheus exposition on a side port from a daemon thread
+
+    Each replica needs a port of its own (see METRICS_PORT in the README).
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        # Usually another replica on this host already has the port - this one would export nothing
+        logging.getLogger(__name__).warning(
+            "metrics not served: cannot bind %s:%s (%s); give each replica its own METRICS_PORT", host, port, e
+        )
+        return
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+def write_metrics_file(metrics, path, interval):
+    """Periodically write the exposition to a file (e.g. for node_exporter's textfile collector)"""
+    def run():
+        while True:
+            try:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(metrics.render())
+                os.replace(tmp_path, path)
+            except OSError:
+                pass
+            time.sleep(interval)
+    
+    threading.Thread(target=run, name="metrics-file", daemon=True).start()
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    """Create the metrics registry shared by all sessions and start its exporters"""
+    metrics = MetricsRegistry(tracer=get_tracer())
+    if METRICS_PORT:
+        serve_metrics(metrics, METRICS_PORT, METRICS_HOST)
+    if METRICS_FILE:
+        write_metrics_file(metrics, METRICS_FILE, METRICS_FILE_INTERVAL)
+    return metrics
+
 # Initialize Memobase client
 def init_memobase():
-    """Initialize Memobase client for long-term memory"""
+    """Initialize Memobase client for long-term memory (None when no API key is set)"""
+    project_url = os.getenv("MEMOBASE_URL", "https://api.memobase.dev")
+    api_key = os.getenv("MEMOBASE_API_KEY")
+    
+    if not api_key:
+        return None
+    return MemoBaseClient(project_url=project_url, api_key=api_key)
+
+@st.cache_resource(show_spinner=False)
+def get_memobase_client():
+    """Create the Memobase client once per process and share it across sessions"""
     try:
-        project_url = os.getenv("MEMOBASE_URL", "https://api.memobase.dev")
-        api_key = os.getenv("MEMOBASE_API_KEY")
+        return init_memobase()
+    except Exception:
+        return None
+
+class MemobaseHealth:
+    """Tracks whether Memobase is reachable without pinging it on every visit
+
+    A background thread pings the server every ttl seconds. Failures of real
+    calls are reported too, and after max_failures consecutive failures the
+    memory features are marked degraded until a call succeeds again.
+    """
+    
+    def __init__(self, memobase_client, ttl=30.0, max_failures=3):
+        self.memobase_client = memobase_client
+        self.ttl = ttl
+        self.max_failures = max_failures
+        self.consecutive_failures = 0
+        self.last_checked = None
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="memobase-health", daemon=True).start()
+    
+    @property
+    def degraded(self):
+        with self._lock:
+            return self.consecutive_failures >= self.max_failures
+    
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.last_checked = time.time()
+    
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_checked = time.time()
+    
+    def _run(self):
+        while True:
+            try:
+                healthy = self.memobase_client.ping()
+            except Exception:
+                healthy = False
+            if healthy:
+                self.record_success()
+            else:
+                self.record_failure()
+            time.sleep(self.ttl)
+
+@st.cache_resource(show_spinner=False)
+def get_memobase_health():
+    """Create the shared Memobase health prober (None when memory is disabled)"""
+    memobase_client = get_memobase_client()
+    if memobase_client is None:
+        return None
+    return MemobaseHealth(memobase_client, ttl=MEMOBASE_HEALTH_TTL, max_failures=MEMOBASE_MAX_FAILURES)
+
+def memobase_available():
+    """True when the shared Memobase client exists and isn't marked degraded"""
+    health = get_memobase_health()
+    return health is not None and not health.degraded
+
+def fetch_memory_context(memobase_user):
+    """Fetch the user's memory context from Memobase (optimized for speed)"""
+    return memobase_user.context(
+        max_token_size=500,  # Reduced from 1000 for speed
+        profile_event_ratio=0.5,  # Balanced ratio
+        require_event_summary=False  # Skip summaries for speed
+    )
+
+class MemoryContextCache:
+    """Per-user cache of Memobase context, refreshed in the background
+
+    A user's context changes when they save a conversation (invalidate() is
+    called from the save path), but also when Memobase finishes extracting
+    their profile or another replica saves for them - so entries also expire
+    after ttl seconds. prefetch() warms the cache on a worker thread while
+    the user is still typing. Failed fetches are reported to the health
+    tracker and the user's next fetch waits out an exponential backoff.
+    """
+    
+    def __init__(self, metrics, health=None, ttl=300.0, retry_backoff=5.0, max_backoff=300.0,
+                 max_users=1000, max_workers=4):
+        self.metrics = metrics
+        self.health = health
+        self.ttl = ttl
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.max_users = max_users
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="memobase-context")
+        self._lock = threading.Lock()
+        self._contexts = OrderedDict()  # user_id -> (context string, fetched at)
+        self._pending = {}  # user_id -> Future of an in-flight fetch
+        self._generations = {}  # user_id -> bumped on every invalidation
+        self._failures = {}  # user_id -> [consecutive failures, no fetch before]
+    
+    def prefetch(self, memobase_user):
+        """Start fetching the user's context in the background unless already cached
+
+        Returns a Future; callers wait on it with their own deadline. Returns
+        None while backing off after failed fetches.
+        """
+        uid = memobase_user.user_id
+        with self._lock:
+            cached = self._contexts.get(uid)
+            if cached is not None and time.time() - cached[1] < self.ttl:
+                self._contexts.move_to_end(uid)
+                future = Future()
+                future.set_result(cached[0])
+                return future
+            if uid not in self._pending:
+                failure = self._failures.get(uid)
+                if failure is not None and time.time() < failure[1]:
+                    return None
+                generation = self._generations.get(uid, 0)
+                self._pending[uid] = self._executor.submit(self._fetch, memobase_user, generation)
+            return self._pending[uid]
+    
+    def invalidate(self, user_id):
+        """Drop the cached context after the user's memory has changed"""
+        with self._lock:
+            self._contexts.pop(user_id, None)
+            self._pending.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+    
+    def _fetch(self, memobase_user, generation):
+        uid = memobase_user.user_id
+        try:
+            with self.metrics.timer("memory_context_fetch"):
+                context = fetch_memory_context(memobase_user)
+        except Exception:
+            with self._lock:
+                if self._generations.get(uid, 0) == generation:
+                    self._pending.pop(uid, None)
+                failures = self._failures.get(uid, [0, 0])[0] + 1
+                backoff = min(self.retry_backoff * (2 ** (failures - 1)), self.max_backoff)
+                self._failures[uid] = [failures, time.time() + backoff]
+                while len(self._failures) > self.max_users:
+                    self._failures.pop(next(iter(self._failures)))
+            if self.health is not None:
+                self.health.record_failure()
+            raise
         
-        if not api_key:
-            st.warning("⚠️ Memobase API key not found. Memory features disabled.")
+        if self.health is not None:
+            self.health.record_success()
+        with self._lock:
+            self._failures.pop(uid, None)
+            # A save during the fetch makes this result stale - don't keep it
+            if self._generations.get(uid, 0) == generation:
+                self._pending.pop(uid, None)
+                self._contexts[uid] = (context, time.time())
+                self._contexts.move_to_end(uid)
+                while len(self._contexts) > self.max_users:
+                    self._contexts.popitem(last=False)
+        return context
+
+@st.cache_resource(show_spinner=False)
+def get_memory_context_cache():
+    """Create the memory context cache shared by all sessions"""
+    return MemoryContextCache(
+        get_metrics(),
+        get_memobase_health(),
+        ttl=MEMORY_CONTEXT_TTL,
+        retry_backoff=MEMORY_CONTEXT_RETRY_BACKOFF
+    )
+
+class MemorySaveQueue:
+    """Background worker that saves conversations to Memobase off the script thread
+
+    Every job is written to a spool directory before it is queued, so saves
+    survive a crash or restart. Each process spools into a subdirectory of
+    its own that it keeps locked while it runs; at startup only the spools
+    of processes that are gone are replayed, so replicas on one host don't
+    insert each other's jobs twice. The worker inserts the queued ChatBlobs of
+    each user and debounces flush(), which triggers the slow server-side
+    profile/event extraction, until the user stops saving for flush_delay
+    seconds. Failed inserts are retried with exponential backoff.
+    """
+    
+    def __init__(self, memobase_client, context_cache, metrics, spool_dir, maxsize=1000,
+                 flush_delay=2.0, max_attempts=5, retry_backoff=1.0):
+        self.memobase_client = memobase_client
+        self.context_cache = context_cache
+        self.metrics = metrics
+        self.spool_dir = spool_dir
+        self.flush_delay = flush_delay
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._statuses = OrderedDict()  # job id -> queued / saved / failed
+        self._retries = []  # (not_before, job)
+        self._unflushed = {}  # user_id -> [last insert time, job ids, flush attempts]
+        
+        self.spool_root = spool_dir
+        self.spool_dir = os.path.join(spool_dir, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._spool_lock = self._lock_spool(self.spool_dir)
+        self._recover_spool()
+        threading.Thread(target=self._run, name="memobase-save", daemon=True).start()
+    
+    def enqueue(self, user_id, messages):
+        """Queue a conversation for saving and return its job id
+
+        Raises queue.Full when the queue is at capacity; never blocks.
+        """
+        job = {"id": uuid.uuid4().hex, "user_id": user_id, "messages": messages, "attempts": 0}
+        self._write_spool(job)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._remove_spool(job)
+            raise
+        self._set_status(job["id"], "queued")
+        return job["id"]
+    
+    def status(self, job_id):
+        """Return 'queued', 'saved', 'failed' or None for an unknown job"""
+        with self._lock:
+            return self._statuses.get(job_id)
+    
+    def _set_status(self, job_id, status):
+        with self._lock:
+            self._statuses[job_id] = status
+            self._statuses.move_to_end(job_id)
+            while len(self._statuses) > 10000:
+                self._statuses.popitem(last=False)
+    
+    def _spool_path(self, job):
+        return os.path.join(self.spool_dir, f"{job['id']}.json")
+    
+    def _write_spool(self, job):
+        tmp_path = self._spool_path(job) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._spool_path(job))
+    
+    def _remove_spool(self, job):
+        try:
+            os.remove(self._spool_path(job))
+        except OSError:
+            pass
+    
+    @staticmethod
+    def _lock_spool(path):
+        """Lock a spool directory; returns the open lock file, or None if a live process holds it"""
+        if fcntl is None:
             return None
-            
-        mb = MemoBaseClient(project_url=project_url, api_key=api_key)
-        if mb.ping():
-            return mb
-        else:
-            st.warning("⚠️ Could not connect to Memobase. Memory features disabled.")
+        lock_file = open(os.path.join(path, ".lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
             return None
-    except Exception as e:
-        st.warning(f"⚠️ Memobase initialization failed: {str(e)}")
+        return lock_file
+    
+    def _recover_spool(self):
+        """Requeue jobs left in the spool by processes that are gone"""
+        orphans = [self.spool_root]  # jobs spooled by versions without per-process directories
+        if fcntl is not None:
+            for name in os.listdir(self.spool_root):
+                path = os.path.join(self.spool_root, name)
+                if path != self.spool_dir and os.path.isdir(path):
+                    orphans.append(path)
+        
+        for path in orphans:
+            lock_file = None
+            if path != self.spool_root:
+                lock_file = self._lock_spool(path)
+                if lock_file is None:
+                    # Its process is still running and will insert these itself
+                    continue
+            for name in sorted(os.listdir(path)):
+                if not name.endswith(".json"):
+                    continue
+                claimed = os.path.join(self.spool_dir, name)
+                try:
+                    # Claim the job: a rename is atomic, so only one process gets it
+                    os.rename(os.path.join(path, name), claimed)
+                    with open(claimed, encoding="utf-8") as f:
+                        job = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                self._retries.append((0, job))
+                self._set_status(job["id"], "queued")
+            if lock_file is not None:
+                shutil.rmtree(path, ignore_errors=True)
+                lock_file.close()
+    
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self._next_wakeup()))
+                # Drain whatever else is waiting so each user's blobs go in together
+                while len(batch) < 50:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            
+            now = time.time()
+            batch.extend(job for not_before, job in self._retries if not_before <= now)
+            self._retries = [(not_before, job) for not_before, job in self._retries if not_before > now]
+            
+            for job in sorted(batch, key=lambda job: job["user_id"]):
+                self._insert(job)
+            self._flush_due()
+    
+    def _next_wakeup(self):
+        deadlines = [not_before for not_before, job in self._retries]
+        deadlines += [pending[0] + self.flush_delay for pending in self._unflushed.values()]
+        if not deadlines:
+            return 1.0
+        return min(max(min(deadlines) - time.time(), 0.01), 1.0)
+    
+    def _insert(self, job):
+        try:
+            user = self.memobase_client.get_user(job["user_id"], no_get=True)
+            with self.metrics.timer("memory_insert"):
+                user.insert(ChatBlob(messages=job["messages"]))
+        except Exception:
+            self.metrics.inc("cognitype_memory_saves_total", outcome="insert_error")
+            job["attempts"] += 1
+            if job["attempts"] >= self.max_attempts:
+                self._remove_spool(job)
+                self._set_status(job["id"], "failed")
+            else:
+                self._write_spool(job)
+                delay = self.retry_backoff * (2 ** (job["attempts"] - 1))
+                self._retries.append((time.time() + delay, job))
+            return
+        
+        # The blob is stored server-side now; only the flush is still pending
+        self._remove_spool(job)
+        pending = self._unflushed.setdefault(job["user_id"], [0, [], 0])
+        pending[0] = time.time()
+        pending[1].append(job["id"])
+    
+    def _flush_due(self):
+        now = time.time()
+        for user_id, pending in list(self._unflushed.items()):
+            if now - pending[0] < self.flush_delay:
+                continue
+            user = self.memobase_client.get_user(user_id, no_get=True)
+            try:
+                with self.metrics.timer("memory_flush"):
+                    user.flush()
+            except Exception:
+                pending[2] += 1
+                if pending[2] < self.max_attempts:
+                    pending[0] = now
+                    continue
+                # Blobs are already buffered server-side and will be processed eventually
+            
+            del self._unflushed[user_id]
+            for job_id in pending[1]:
+                self._set_status(job_id, "saved")
+            self.metrics.inc("cognitype_memory_saves_total", len(pending[1]), outcome="saved")
+            
+            # Memory changed - refetch the context for the next question
+            self.context_cache.invalidate(user_id)
+            self.context_cache.prefetch(user)
+
+@st.cache_resource(show_spinner=False)
+def get_memory_save_queue():
+    """Create the background save queue shared by all sessions"""
+    return MemorySaveQueue(
+        get_memobase_client(),
+        get_memory_context_cache(),
+        get_metrics(),
+        SAVE_SPOOL_DIR,
+        maxsize=SAVE_QUEUE_MAX_SIZE,
+        flush_delay=SAVE_FLUSH_DELAY
+    )
+
+# Namespace for deriving stable Memobase user ids from browser ids
+MEMOBASE_UID_NAMESPACE = uuid.UUID("6f1c2a9e-3b7d-4c5e-9a8f-2d4b6c8e0f13")
+BROWSER_ID_PATTERN = re.compile(r"^browser_[A-Za-z0-9_-]{8,64}$")
+
+def update_query_params(**updates):
+    """Set URL query parameters without dropping the ones already there"""
+    try:
+        params = st.experimental_get_query_params()
+        params.update({key: value for key, value in updates.items() if value})
+        st.experimental_set_query_params(**params)
+    except Exception:
+        pass  # Ignore if fails
+
+# Browser storage bridge - a tiny custom component that reads and writes localStorage
+_browser_storage_component = components.declare_component(
+    "browser_storage",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "browser_storage")
+)
+
+def browser_storage(writes=None, key="browser_storage"):
+    """Write values to the browser's localStorage and report the stored ones back
+
+    Returns a dict with browserId, name and personality once the browser has
+    answered (one round-trip per page load), None before that.
+    """
+    return _browser_storage_component(writes=writes or {}, key=key, default=None)
+
+def get_browser_user_id(storage_values=None):
+    """Get the stable browser user id
+
+    The id comes from the browser's localStorage (the storage bridge creates
+    it on the first visit). It is never taken from the URL while the browser
+    has an id of its own - a shared link must not hand out the sharer's chat
+    and memory - so the uid URL parameter is only a fallback when the bridge
+    reports no id at all. Returns None until the bridge has answered: a
+    made-up id would key the session's chat and Memobase user to a
+    throwaway id for good.
+    """
+    if storage_values is None:
         return None
+    
+    browser_user_id = storage_values.get("browserId") or ""
+    if BROWSER_ID_PATTERN.match(browser_user_id):
+        return browser_user_id
+    try:
+        url_user_id = st.experimental_get_query_params().get("uid", [""])[0]
+    except Exception:
+        url_user_id = ""
+    if BROWSER_ID_PATTERN.match(url_user_id):
+        return url_user_id
+    return f"browser_{uuid.uuid4().hex}"
+
+@st.cache_resource(show_spinner=False)
+def get_memobase_user_cache():
+    """Process-wide Memobase user id -> User cache so returning users skip add_user"""
+    return {}
+
+def get_or_create_memobase_user(memobase_client, browser_user_id):
+    """Resolve a browser id to its Memobase user, creating the user only on the first visit
+
+    The Memobase user id is always derived from the browser id on the
+    server; ids reported by the browser are never trusted.
+    """
+    uid = str(uuid.uuid5(MEMOBASE_UID_NAMESPACE, browser_user_id))
+    user_cache = get_memobase_user_cache()
+    if uid in user_cache:
+        return user_cache[uid]
+    
+    try:
+        user = memobase_client.get_user(uid)
+    except (ServerError, httpx.HTTPStatusError):
+        # Unknown to Memobase - this is a first visit
+        memobase_client.add_user({
+            "app": "cognitype_chatbot",
+            "created_at": datetime.now().isoformat(),
+            "session_type": "persistent_browser",
+            "browser_user_id": browser_user_id
+        }, id=uid)
+        user = memobase_client.get_user(uid, no_get=True)
+    
+    user_cache[uid] = user
+    return user
+
+# Page assets - a tiny custom component that adds the stylesheet to the page once
+PAGE_ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "page_assets")
+_page_assets_component = components.declare_component("page_assets", path=PAGE_ASSETS_DIR)
+
+@st.cache_resource(show_spinner=False)
+def get_inline_stylesheet():
+    """The stylesheet as a <style> block, read from disk once per process"""
+    with open(os.path.join(PAGE_ASSETS_DIR, "style.css"), encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
+
+def page_assets():
+    """Style the page without resending the stylesheet on every rerun
+
+    The component links style.css into the main page, where it stays across
+    reruns. Only the first run of a session also inlines it, so the page is
+    styled before the component's iframe has loaded.
+    """
+    if not st.session_state.get('stylesheet_inlined'):
+        st.session_state.stylesheet_inlined = True
+        st.markdown(get_inline_stylesheet(), unsafe_allow_html=True)
+    _page_assets_component(key="page_assets", default=None)
 
 # Page configuration
 st.set_page_config(
@@ -41,569 +703,2218 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# JavaScript for localStorage functionality
-st.markdown("""
-<script>
-function saveNameToLocalStorage(name) {
-    localStorage.setItem('cognitype_user_name', name);
-}
+# Custom CSS for modern styling, sent to the browser once per page load
+page_assets()
 
-function getNameFromLocalStorage() {
-    return localStorage.getItem('cognitype_user_name') || '';
-}
+# Constants
+MBTI_TYPES = [
+    "INTJ", "INTP", "ENTJ", "ENTP",
+    "INFJ", "INFP", "ENFJ", "ENFP", 
+    "ISTJ", "ISFJ", "ESTJ", "ESFJ",
+    "ISTP", "ISFP", "ESTP", "ESFP"
+]
 
-function savePersonalityToLocalStorage(personality) {
-    localStorage.setItem('cognitype_personality', personality);
+MBTI_DESCRIPTIONS = {
+    "INTJ": "Architect - Strategic, analytical, and independent",
+    "INTP": "Thinker - Logical, innovative, and curious",
+    "ENTJ": "Commander - Confident, strategic, and natural leaders",
+    "ENTP": "Debater - Quick-witted, clever, and conceptual",
+    "INFJ": "Advocate - Creative, insightful, and principled",
+    "INFP": "Mediator - Idealistic, loyal, and values-driven",
+    "ENFJ": "Protagonist - Charismatic, inspiring, and natural leaders",
+    "ENFP": "Campaigner - Enthusiastic, creative, and sociable",
+    "ISTJ": "Logistician - Practical, fact-minded, and reliable",
+    "ISFJ": "Protector - Warm-hearted, conscientious, and cooperative",
+    "ESTJ": "Executive - Organized, practical, and decisive",
+    "ESFJ": "Consul - Caring, social, and popular",
+    "ISTP": "Virtuoso - Bold, practical, and experimental",
+    "ISFP": "Adventurer - Charming, sensitive, and artistic",
+    "ESTP": "Entrepreneur - Smart, energetic, and perceptive",
+    "ESFP": "Entertainer - Spontaneous, enthusiastic, and playful"
 }
 
-function getPersonalityFromLocalStorage() {
-    return localStorage.getItem('cognitype_personality') || '';
+MBTI_EMOJIS = {
+    "INTJ": "🏗️", "INTP": "🧠", "ENTJ": "👑", "ENTP": "💡",
+    "INFJ": "🌟", "INFP": "🎨", "ENFJ": "🎭", "ENFP": "🦋", 
+    "ISTJ": "📊", "ISFJ": "🛡️", "ESTJ": "⚡", "ESFJ": "🤝",
+    "ISTP": "🔧", "ISFP": "🌸", "ESTP": "��", "ESFP": "🎉"
 }
 
-function getUserIdFromLocalStorage() {
-    return localStorage.getItem('cognitype_user_id') || '';
+MBTI_FACTS = {
+    "INTJ": "INTJs make up only 2% of the population and are known as 'The Architects' - they excel at strategic planning and long-term vision!",
+    "INTP": "INTPs are natural theorists who love exploring complex ideas - they often become scientists, philosophers, or inventors!",
+    "ENTJ": "ENTJs are born leaders who make up 3% of the population - they're excellent at organizing people and resources to achieve goals!",
+    "ENTP": "ENTPs are innovative debaters who see possibilities everywhere - they're great at brainstorming and challenging conventional thinking!",
+    "INFJ": "INFJs are the rarest personality type (1% of population) - they have incredible intuition and often become counselors or writers!",
+    "INFP": "INFPs are idealistic mediators who are driven by their values - they often excel in creative fields and helping professions!",
+    "ENFJ": "ENFJs are natural teachers and mentors - they have an amazing ability to inspire and develop others' potential!",
+    "ENFP": "ENFPs are enthusiastic campaigners who bring energy to everything - they're excellent at connecting with people and generating ideas!",
+    "ISTJ": "ISTJs are reliable logisticians who value tradition and stability - they're the backbone of many organizations!",
+    "ISFJ": "ISFJs are caring protectors who remember details about people they care about - they're often found in healthcare and education!",
+    "ESTJ": "ESTJs are efficient executives who get things done - they're natural organizers and often become successful managers!",
+    "ESFJ": "ESFJs are warm-hearted consuls who create harmony in groups - they're excellent at reading social dynamics!",
+    "ISTP": "ISTPs are practical virtuosos who love working with their hands - they're great at troubleshooting and mechanical tasks!",
+    "ISFP": "ISFPs are gentle adventurers with strong aesthetic sense - they often excel in arts, music, or nature-related fields!",
+    "ESTP": "ESTPs are energetic entrepreneurs who live in the moment - they're great at crisis management and hands-on problem solving!",
+    "ESFP": "ESFPs are spontaneous entertainers who bring joy to others - they're natural performers and excellent at reading people's emotions!"
 }
 
-function saveUserIdToLocalStorage(userId) {
-    localStorage.setItem('cognitype_user_id', userId);
-}
+# LLM backend: "together", "openai" (any OpenAI-compatible server) or "fake" (offline, for load tests)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "together").lower()
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
 
-function getMemobaseUserIdFromLocalStorage() {
-    return localStorage.getItem('cognitype_memobase_uid') || '';
-}
+# Together.ai API settings (the URL can be pointed at a local server for testing)
+TOGETHER_API_URL = os.getenv("TOGETHER_API_URL", "https://api.together.xyz/v1/chat/completions")
+TOGETHER_MODEL = os.getenv("TOGETHER_MODEL", "mistralai/Mistral-7B-Instruct-v0.1")
 
-function saveMemobaseUserIdToLocalStorage(uid) {
-    localStorage.setItem('cognitype_memobase_uid', uid);
-}
+# OpenAI-compatible API settings (OpenAI, vLLM, Ollama, LM Studio, ...)
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
-// New functions for browser-to-memobase mapping
-function getBrowserIdFromLocalStorage() {
-    return localStorage.getItem('cognitype_browser_user_id') || '';
-}
+# Offline fake backend: seconds before the first token, then tokens per second
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.5"))
+FAKE_LLM_TOKENS_PER_SEC = float(os.getenv("FAKE_LLM_TOKENS_PER_SEC", "50"))
+FAKE_LLM_RESPONSE_TOKENS = int(os.getenv("FAKE_LLM_RESPONSE_TOKENS", "120"))
 
-function saveBrowserIdToLocalStorage(browserId) {
-    localStorage.setItem('cognitype_browser_user_id', browserId);
-}
+# Hedged requests: a duplicate goes to the fallback backend when the primary's first token
+# is slower than this percentile of recent first-token latencies ("" = no fallback)
+LLM_FALLBACK_BACKEND = os.getenv("LLM_FALLBACK_BACKEND", "").lower()
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "3"))  # seconds, until enough samples
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
 
-function getMemobaseMappingForBrowser(browserId) {
-    return localStorage.getItem('cognitype_memobase_mapping_' + browserId) || '';
-}
+# Circuit breaker: stop calling a backend after this many consecutive failures, retry after the timeout
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
 
-function saveMemobaseMappingForBrowser(browserId, memobaseId) {
-    localStorage.setItem('cognitype_memobase_mapping_' + browserId, memobaseId);
+# Sampling parameters sent with every completion request
+GENERATION_PARAMS = {
+    "temperature": 0.7,
+    "top_p": 0.7
+}
+# Extra sampling parameters only Together understands
+TOGETHER_GENERATION_PARAMS = {
+    "top_k": 50,
+    "repetition_penalty": 1,
+    "stop": ["\x07"]
 }
-</script>
-""", unsafe_allow_html=True)
 
-# Custom CSS for modern styling
-st.markdown("""
-<style>
-    /* Import Google Fonts */
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
-    
-    /* Global Styles */
-    .main {
-        font-family: 'Inter', sans-serif;
-        padding-top: 1rem !important;
-    }
+# Token budget for prompt assembly
+MODEL_CONTEXT_WINDOW = int(os.getenv("MODEL_CONTEXT_WINDOW", "8192"))
+MAX_COMPLETION_TOKENS = int(os.getenv("MAX_COMPLETION_TOKENS", "512"))
+MIN_COMPLETION_TOKENS = int(os.getenv("MIN_COMPLETION_TOKENS", "128"))
+MESSAGE_OVERHEAD_TOKENS = 4  # chat template tokens around each message
+# Optional path to Mistral's tokenizer.json for exact counts (needs the tokenizers package)
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", "")
+
+# Chat history: conversations rendered per page, older ones are loaded on demand
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10"))
+
+# Chat history memory: turns kept in memory per session, turns kept at all, and where older turns spill
+HISTORY_MEMORY_TURNS = int(os.getenv("HISTORY_MEMORY_TURNS", "20"))
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "500"))
+HISTORY_SPILL_DIR = os.getenv("HISTORY_SPILL_DIR", ".cache/history")
+HISTORY_SPILL_COMPRESS = os.getenv("HISTORY_SPILL_COMPRESS", "true").lower() == "true"
+
+# Multi-turn chat: turns sent verbatim and rolling summary lines kept for older turns
+CHAT_WINDOW_TURNS = int(os.getenv("CHAT_WINDOW_TURNS", "4"))
+CHAT_SUMMARY_MAX_LINES = int(os.getenv("CHAT_SUMMARY_MAX_LINES", "20"))
+
+# Response cache settings (backend: memory, sqlite or off)
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", ".cache/responses.sqlite3")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+# Sampled (temperature > 0) answers are only reused when this is switched on
+RESPONSE_CACHE_OPT_IN = os.getenv("RESPONSE_CACHE_OPT_IN", "false").lower() == "true"
+
+# Semantic cache: reuse answers to rewordings of a question (per type, questions without memory or chat context)
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))  # tune with bench/tune_semantic_cache.py
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "500"))  # per personality type
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "")  # sentence-transformers model; empty: hashed n-grams
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "1024"))
+
+# Chat state store: memory, sqlite or redis (shared by replicas, needs the redis package), or off
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", ".cache/chat_state.sqlite3")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+STATE_TTL = float(os.getenv("STATE_TTL", "604800"))  # seconds a browser's chat is kept after its last change
+STATE_MAX_SESSIONS = int(os.getenv("STATE_MAX_SESSIONS", "1000"))  # in-memory backend only (keeps HISTORY_MEMORY_TURNS per chat)
+STATE_MAX_TURNS = int(os.getenv("STATE_MAX_TURNS", str(HISTORY_MAX_TURNS)))  # newest turns of a chat kept by sqlite/redis
+
+# How long a question may wait for Memobase before it is answered without memory
+MEMORY_FETCH_BUDGET_MS = int(os.getenv("MEMORY_FETCH_BUDGET_MS", "300"))
+
+# Memobase health checks: ping interval and failures before memory is marked degraded
+MEMOBASE_HEALTH_TTL = float(os.getenv("MEMOBASE_HEALTH_TTL", "30"))
+MEMOBASE_MAX_FAILURES = int(os.getenv("MEMOBASE_MAX_FAILURES", "3"))
+
+# Memory context cache: seconds a user's context is reused, and the first retry delay after a failed fetch
+MEMORY_CONTEXT_TTL = float(os.getenv("MEMORY_CONTEXT_TTL", "300"))
+MEMORY_CONTEXT_RETRY_BACKOFF = float(os.getenv("MEMORY_CONTEXT_RETRY_BACKOFF", "5"))
+
+# Background save queue settings
+SAVE_SPOOL_DIR = os.getenv("SAVE_SPOOL_DIR", ".cache/save_spool")
+SAVE_QUEUE_MAX_SIZE = int(os.getenv("SAVE_QUEUE_MAX_SIZE", "1000"))
+SAVE_FLUSH_DELAY = float(os.getenv("SAVE_FLUSH_DELAY", "2"))
+
+# Compare mode: most personalities asked at once, and worker threads shared by all sessions
+COMPARE_MAX_TYPES = int(os.getenv("COMPARE_MAX_TYPES", "4"))
+FANOUT_MAX_WORKERS = int(os.getenv("FANOUT_MAX_WORKERS", "16"))
+
+# Inference jobs: answers are produced on a shared worker pool, off the Streamlit script thread
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "16"))
+INFERENCE_MAX_PENDING = int(os.getenv("INFERENCE_MAX_PENDING", "200"))
+INFERENCE_RESULT_TTL = float(os.getenv("INFERENCE_RESULT_TTL", "600"))  # seconds a finished answer is kept
+INFERENCE_POLL_INTERVAL = float(os.getenv("INFERENCE_POLL_INTERVAL", "0.25"))  # seconds between answer panel updates
+
+# Outbound LLM traffic shaping: per-user token bucket plus a global concurrency cap
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_RATE_PER_MINUTE = float(os.getenv("LLM_RATE_PER_MINUTE", "10"))
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "4"))  # room for one full comparison
+LLM_MAX_QUEUE_WAIT = float(os.getenv("LLM_MAX_QUEUE_WAIT", "30"))
+# Identical prompts already on their way upstream share that one call
+LLM_COALESCE = os.getenv("LLM_COALESCE", "true").lower() == "true"
+
+# HTTP connection pool settings for outbound API calls
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+
+# Metrics: Prometheus text on a side port and/or written to a file (0 / "" = off),
+# and OpenTelemetry spans per stage when the opentelemetry packages are installed
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # 0.0.0.0 to let a scraper on another host in
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_FILE_INTERVAL = float(os.getenv("METRICS_FILE_INTERVAL", "15"))
+OTEL_TRACING = os.getenv("OTEL_TRACING", "false").lower() == "true"
+
+def loading_animation_html(message):
+    """HTML for the animated loading dots with a status message underneath"""
+    return f"""
+    <div class="loading-animation">
+        <div class="loading-dots">
+            <div></div>
+            <div></div>
+            <div></div>
+            <div></div>
+        </div>
+    </div>
+    <p style="text-align: center; margin-top: 1rem;">
+        {message}
+    </p>
+    """
+
+def ai_message_html(mbti_type, response):
+    """HTML for an assistant chat bubble (highlighted in red for errors)"""
+    if response.startswith("Error:"):
+        return f"""
+        <div class="chat-message" style="border-left: 4px solid #e53e3e; background: #fed7d7;">
+            <strong>🤖 AI Assistant</strong><br>
+            {response}
+        </div>
+        """
+    return f"""
+    <div class="chat-message ai-message">
+        <strong>🤖 {mbti_type} Assistant</strong><br>
+        {response}
+    </div>
+    """
+
+class ConversationTurn:
+    """One question and answer of the chat history
+
+    Slots instead of a dict, an interned type name and a float creation time
+    keep each turn small; the timestamp string is only formatted for display.
+    """
+    __slots__ = ('mbti_type', 'question', 'response', 'created', 'summary', 'html')
     
-    /* Remove default Streamlit padding */
-    .block-container {
-        padding-top: 0.5rem !important;
-        padding-bottom: 1rem !important;
-    }
+    def __init__(self, mbti_type, question, response, created=None, summary=None):
+        self.mbti_type = sys.intern(mbti_type)
+        self.question = question
+        self.response = response
+        self.created = time.time() if created is None else created
+        self.summary = summary
+        self.html = None
     
-    /* Hide scrollbar */
-    html {
-        overflow-x: hidden !important;
-        overflow-y: auto !important;
-    }
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.created).strftime("%H:%M")
     
-    body {
-        overflow-x: hidden !important;
-        overflow-y: auto !important;
-    }
+    @property
+    def failed(self):
+        return self.response.startswith("Error:")
     
-    /* Move content higher */
-    .main .block-container {
-        padding-top: 0rem !important;
-        margin-top: -1rem !important;
-        max-width: 100% !important;
-    }
+    def to_row(self):
+        return [self.mbti_type, self.question, self.response, self.created, self.summary]
+
+class ConversationHistory:
+    """A session's chat history with bounded memory
+
+    The newest memory_turns turns stay in memory. Older turns are spilled to
+    disk in segments (zlib-compressed when compress is set) and read back
+    only when needed, e.g. when the user pages back through the history.
+    Only about the newest max_turns turns are kept at all; whole segments
+    are dropped once they fall past the cap.
+
+    Turns keep their absolute index for the whole session, so indices used
+    as keys (like save jobs) stay valid when old turns are dropped. Valid
+    indices are range(history.first, len(history)).
+    """
     
-    /* Header Styling */
-    .main-header {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        padding: 1.5rem;
-        border-radius: 15px;
-        margin-bottom: 1rem;
-        margin-top: -1rem !important;
-        text-align: center;
-        color: white;
-        box-shadow: 0 10px 30px rgba(0,0,0,0.1);
-    }
+    def __init__(self, memory_turns=20, max_turns=500, spill_dir=".cache/history", compress=True, first=0):
+        self.memory_turns = max(memory_turns, 2)
+        self.max_turns = max(max_turns, self.memory_turns)
+        self.spill_dir = spill_dir
+        self.compress = compress
+        self.first = first
+        self._recent = []
+        self._recent_start = first
+        self._segments = []  # (first index, turn count, path), oldest first
+        self._loaded = (None, None)  # the last segment read back: (path, turns)
+        self._dir = None
     
-    .main-title {
-        font-size: 2.5rem;
-        font-weight: 700;
-        margin: 0;
-        text-shadow: 2px 2px 4px rgba(0,0,0,0.3);
-    }
+    def __len__(self):
+        return self._recent_start + len(self._recent)
     
-    .main-subtitle {
-        font-size: 1.2rem;
-        margin-top: 0.5rem;
-        opacity: 0.9;
-        font-weight: 300;
-    }
+    def __bool__(self):
+        return len(self) > self.first
     
-    /* MBTI Type Cards */
-    .mbti-card {
-        background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-        padding: 1.5rem;
-        border-radius: 15px;
-        color: white;
-        margin: 1rem 0;
-        box-shadow: 0 8px 25px rgba(0,0,0,0.1);
-        transition: transform 0.3s ease, box-shadow 0.3s ease;
-    }
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not self.first <= index < len(self):
+            raise IndexError("conversation turn not retained")
+        if index >= self._recent_start:
+            return self._recent[index - self._recent_start]
+        for start, count, path in self._segments:
+            if start <= index < start + count:
+                return self._read_segment(path)[index - start]
+        raise IndexError("conversation turn not retained")
     
-    .mbti-card:hover {
-        transform: translateY(-5px);
-        box-shadow: 0 15px 35px rgba(0,0,0,0.2);
-    }
+    def __iter__(self):
+        for index in range(self.first, len(self)):
+            yield self[index]
     
-    .mbti-type {
-        font-size: 2rem;
-        font-weight: 700;
-        margin-bottom: 0.5rem;
-    }
+    def append(self, turn):
+        self._recent.append(turn)
+        if len(self._recent) > self.memory_turns:
+            self._spill(self.memory_turns // 2)
+        while self._segments and len(self) - sum(self._segments[0][:2]) >= self.max_turns:
+            start, count, path = self._segments.pop(0)
+            self._remove(path)
+            self.first = start + count
+    
+    def clear(self):
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+        self.__init__(self.memory_turns, self.max_turns, self.spill_dir, self.compress)
+    
+    def __del__(self):
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+    
+    def _spill(self, count):
+        """Move the oldest count in-memory turns to a segment file"""
+        if self._dir is None:
+            self._dir = os.path.join(self.spill_dir, uuid.uuid4().hex)
+            os.makedirs(self._dir, exist_ok=True)
+        turns = self._recent[:count]
+        data = json.dumps([turn.to_row() for turn in turns], separators=(",", ":"), ensure_ascii=False).encode('utf-8')
+        path = os.path.join(self._dir, f"{self._recent_start}.seg")
+        try:
+            with open(path, 'wb') as f:
+                f.write(zlib.compress(data) if self.compress else data)
+        except OSError:
+            # Keep the turns in memory rather than lose them
+            return
+        self._segments.append((self._recent_start, count, path))
+        del self._recent[:count]
+        self._recent_start += count
+    
+    def _read_segment(self, path):
+        if self._loaded[0] != path:
+            with open(path, 'rb') as f:
+                data = f.read()
+            rows = json.loads((zlib.decompress(data) if self.compress else data).decode('utf-8'))
+            self._loaded = (path, [ConversationTurn(*row) for row in rows])
+        return self._loaded[1]
+    
+    def _remove(self, path):
+        if self._loaded[0] == path:
+            self._loaded = (None, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def new_conversation_history(first=0):
+    return ConversationHistory(HISTORY_MEMORY_TURNS, HISTORY_MAX_TURNS, HISTORY_SPILL_DIR, HISTORY_SPILL_COMPRESS, first)
+
+def user_message_html(turn):
+    """HTML for the user's side of a conversation turn"""
+    return f"""
+            <div class="chat-message user-message">
+                <strong>💬 You ({turn.mbti_type}) - {turn.timestamp}</strong><br>
+                {turn.question}
+            </div>
+            """
+
+def conversation_html(turn):
+    """User and assistant HTML of a turn, built once and kept on the turn"""
+    if turn.html is None:
+        turn.html = (user_message_html(turn), ai_message_html(turn.mbti_type, turn.response))
+    return turn.html
+
+def get_session_user_id():
+    """Identify the current user for rate limiting (browser id, else the session id)"""
+    if st.session_state.get("browser_user_id"):
+        return st.session_state.browser_user_id
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "anonymous"
+
+def get_api_key():
+    """Get the API key of the configured LLM backend from environment variables"""
+    api_key_env = get_llm_backend().api_key_env
+    if not api_key_env:
+        return ""
+    api_key = os.getenv(api_key_env)
+    if not api_key:
+        st.error(f"⚠️ {api_key_env} environment variable is not set!")
+        st.stop()
+    return api_key
+
+def build_system_prompt(mbti_type):
+    """Static instructions for one personality type - identical for every request"""
+    return f"""You are an AI chatbot that has the {mbti_type} personality type ({MBTI_DESCRIPTIONS.get(mbti_type, '')}). 
+You are responding TO a user, not AS the user. You have the {mbti_type} cognitive preferences, communication style, and decision-making approach.
+Think and respond like someone with {mbti_type} personality would - with their strengths, perspectives, and communication patterns.
+
+IMPORTANT: If the context from previous conversations contains information about the USER (like their occupation, interests, or personal details), reference that information when responding. You know this about the user from your previous conversations with them.
+
+Instructions for your response:
+- Respond as a {mbti_type} personality type chatbot
+- Use the specific communication style and thinking patterns of {mbti_type}
+- Reference what you know about the USER from previous conversations
+- Give advice/opinions based on your {mbti_type} perspective
+- Be helpful while maintaining your {mbti_type} personality traits"""
+
+@st.cache_resource(show_spinner=False)
+def get_tokenizer():
+    """Load Mistral's tokenizer.json when configured (needs the optional tokenizers package)"""
+    if not TOKENIZER_PATH:
+        return None
+    try:
+        from tokenizers import Tokenizer
+        return Tokenizer.from_file(TOKENIZER_PATH)
+    except Exception:
+        return None
+
+def count_tokens(text):
+    """Count tokens with Mistral's tokenizer, or estimate them (about four characters per token)"""
+    if not text:
+        return 0
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return max(1, round(len(text) / 4))
+
+@st.cache_resource(show_spinner=False)
+def get_system_prompts():
+    """Build the 16 per-type system prompts once per process, with their token counts"""
+    prompts = {mbti_type: build_system_prompt(mbti_type) for mbti_type in MBTI_TYPES}
+    token_counts = {mbti_type: count_tokens(prompt) for mbti_type, prompt in prompts.items()}
+    return prompts, token_counts
+
+def create_personalized_prompt(mbti_type, user_question, memory_context="", chat_context=None):
+    """Create the chat messages for a question, personalized with the user's memory
+
+    The per-type system prompt never changes, so every request for a type
+    shares the same prefix and benefits from the provider's prefix cache;
+    earlier turns (in multi-turn mode), memory and the question follow it.
+    """
+    system_prompts, _ = get_system_prompts()
+    chat_context = chat_context or {}
+    
+    if memory_context and memory_context.strip():
+        memory_context = f"\n<user_memory>\n{memory_context.strip()}\n</user_memory>\n"
+    else:
+        memory_context = ""
+    summary = chat_context.get("summary")
+    if summary:
+        memory_context = f"\n<earlier_in_this_chat>\n{summary}\n</earlier_in_this_chat>\n{memory_context}"
+    
+    messages = [
+        {
+            "role": "system",
+            "content": system_prompts[mbti_type]
+        }
+    ]
+    for question, response in chat_context.get("turns", []):
+        messages.append({"role": "user", "content": question})
+        messages.append({"role": "assistant", "content": response})
+    messages.append({
+        "role": "user",
+        "content": f"""{memory_context}
+User's Question: {user_question}
+
+Your response as a {mbti_type} chatbot:""".lstrip()
+    })
+    return messages
+
+def first_sentence(text, max_words):
+    """First sentence of text, cut to at most max_words words"""
+    sentence = re.split(r"(?<=[.!?])\s", " ".join(text.split()), maxsplit=1)[0]
+    words = sentence.split()
+    return " ".join(words[:max_words]) + ("..." if len(words) > max_words else "")
+
+def summarize_turn(turn):
+    """One-line extractive summary of a turn, computed once and kept on the turn"""
+    if turn.summary is None:
+        turn.summary = (
+            f"- User asked: {first_sentence(turn.question, 25)} "
+            f"/ {turn.mbti_type} answered: {first_sentence(turn.response, 30)}"
+        )
+    return turn.summary
+
+def build_chat_context(history, state):
+    """Earlier turns for multi-turn mode: a sliding window plus a rolling summary
+
+    The last CHAT_WINDOW_TURNS answered turns are sent verbatim. Turns that
+    slide out of the window are summarized once and appended to a rolling
+    summary kept in state, so each new turn only costs the work for the turn
+    it evicts - and only the newest turns of the history are ever read.
+    """
+    window = []
+    window_start = len(history)
+    while window_start > history.first and len(window) < CHAT_WINDOW_TURNS:
+        window_start -= 1
+        if not history[window_start].failed:
+            window.insert(0, history[window_start])
+    
+    summarized = max(state.get('chat_summarized_turns', 0), history.first)
+    summary_lines = state.get('chat_summary_lines', [])
+    for index in range(summarized, window_start):
+        if not history[index].failed:
+            summary_lines.append(summarize_turn(history[index]))
+    state['chat_summary_lines'] = summary_lines[-CHAT_SUMMARY_MAX_LINES:]
+    state['chat_summarized_turns'] = max(summarized, window_start)
     
-    .mbti-description {
-        font-size: 1rem;
-        opacity: 0.9;
-        line-height: 1.4;
+    return {
+        "summary": "\n".join(state['chat_summary_lines']),
+        "turns": [(turn.question, turn.response) for turn in window]
     }
+
+class PromptTooLargeError(ValueError):
+    """The question alone doesn't fit in the model's context window"""
+
+def trim_to_token_budget(text, budget, keep_end=False):
+    """Keep whole lines from the start (or end) of text while they fit in budget tokens"""
+    if count_tokens(text) <= budget:
+        return text
+    lines = text.splitlines()
+    if keep_end:
+        lines.reverse()
+    kept = []
+    used = 0
+    for line in lines:
+        line_tokens = count_tokens(line) + 1
+        if used + line_tokens > budget:
+            break
+        kept.append(line)
+        used += line_tokens
+    if keep_end:
+        kept.reverse()
+    return "\n".join(kept)
+
+def assemble_prompt(mbti_type, user_question, memory_context="", chat_context=None):
+    """Build the prompt within the model's context window
+
+    Returns (messages, max_tokens). The question always goes in whole and the
+    answer keeps at least MIN_COMPLETION_TOKENS. Memory, then the most recent
+    earlier turns, then the rolling chat summary only get the room left after
+    a full-length answer, and max_tokens shrinks to what remains.
+    Raises PromptTooLargeError when the question itself is too long.
+    """
+    _, system_tokens = get_system_prompts()
+    base_messages = create_personalized_prompt(mbti_type, user_question)
+    fixed_tokens = system_tokens[mbti_type] + count_tokens(base_messages[1]["content"])
+    fixed_tokens += MESSAGE_OVERHEAD_TOKENS * len(base_messages)
+    
+    if fixed_tokens + MIN_COMPLETION_TOKENS > MODEL_CONTEXT_WINDOW:
+        raise PromptTooLargeError(f"Prompt needs {fixed_tokens} tokens")
+    
+    # Optional parts only get the room left after a full-length answer
+    prompt_tokens = fixed_tokens
+    room = max(MODEL_CONTEXT_WINDOW - fixed_tokens - MAX_COMPLETION_TOKENS, 0)
+    
+    memory_context = trim_to_token_budget(memory_context, room) if memory_context else ""
+    if memory_context:
+        memory_tokens = count_tokens(memory_context) + 4
+        prompt_tokens += memory_tokens
+        room -= memory_tokens
+    
+    # Newest turns first - drop the oldest ones that don't fit
+    chat_context = chat_context or {}
+    turns = []
+    for question, response in reversed(chat_context.get("turns", [])):
+        turn_tokens = count_tokens(question) + count_tokens(response) + 2 * MESSAGE_OVERHEAD_TOKENS
+        if turn_tokens > room:
+            break
+        turns.insert(0, (question, response))
+        prompt_tokens += turn_tokens
+        room -= turn_tokens
+    
+    summary = trim_to_token_budget(chat_context.get("summary", ""), max(room - 8, 0), keep_end=True)
+    if summary:
+        summary_tokens = count_tokens(summary) + 8
+        prompt_tokens += summary_tokens
+        room -= summary_tokens
+    
+    messages = create_personalized_prompt(
+        mbti_type, user_question, memory_context, {"summary": summary, "turns": turns}
+    )
+    max_tokens = min(MAX_COMPLETION_TOKENS, MODEL_CONTEXT_WINDOW - prompt_tokens)
+    return messages, max_tokens
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """Create the pooled keep-alive HTTP session shared by all Streamlit sessions"""
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["POST"]),
+        # Never retry a read timeout: the request reached the model and may be billed, and the
+        # caller should see "timed out" rather than a connection error after several attempts
+        read=False,
+        # Retry-After on a 429 can be minutes long - use our own short backoff instead
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry
+    )
+    
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+class CancelEvent(threading.Event):
+    """An Event that also runs callbacks when it is set, e.g. to abort a blocking read"""
+    
+    def __init__(self):
+        super().__init__()
+        self._callbacks = []
+        self._callback_lock = threading.Lock()
+    
+    def add_callback(self, callback):
+        """Run callback when the event is set (right away if it already is)"""
+        with self._callback_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+    
+    def remove_callback(self, callback):
+        with self._callback_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+    
+    def set(self):
+        with self._callback_lock:
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+def abort_response(response):
+    """Close a streaming response from another thread
+
+    Closing alone leaves a read that is blocked on the socket waiting for
+    HTTP_READ_TIMEOUT; shutting the socket down wakes it up at once.
+    """
+    try:
+        response.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        # Already released to the pool or closed
+        pass
+    response.close()
+
+def read_sse_stream(response, on_token, cancel_event=None):
+    """Read a server-sent-event completion stream, passing each text delta to on_token"""
+    chunks = []
+    try:
+        for line in response.iter_lines():
+            if cancel_event is not None and cancel_event.is_set():
+                response.close()
+                return "Error: Request cancelled."
+            line = line.decode('utf-8') if isinstance(line, bytes) else line
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get('choices') or []
+            if not choices:
+                continue
+            text = (choices[0].get('delta') or {}).get('content') or choices[0].get('text') or ""
+            if text:
+                chunks.append(text)
+                on_token(text)
+    except requests.exceptions.RequestException as e:
+        if cancel_event is not None and cancel_event.is_set():
+            # The response was aborted under the read
+            return "Error: Request cancelled."
+        # requests reports a read timeout in the middle of a stream as a connection error
+        if isinstance(e, requests.exceptions.ConnectionError) and e.args and isinstance(e.args[0], ReadTimeoutError):
+            raise requests.exceptions.ReadTimeout(e)
+        raise
+
+    content = "".join(chunks).strip()
+    if content:
+        return content
+    return "Error: No response content received from the API."
+
+class OpenAICompatibleBackend:
+    """Chat completions over HTTP from any server that speaks the OpenAI API"""
+    
+    name = "openai"
+    api_key_env = "OPENAI_API_KEY"
+    
+    def __init__(self, url, model, extra_params=None):
+        self.url = url
+        self.model = model
+        self.params = {**GENERATION_PARAMS, **(extra_params or {})}
+    
+    def complete(self, messages, api_key, on_token=None, max_tokens=None, cancel_event=None):
+        """Return the completion for a list of chat messages
+
+        When on_token is given the completion is streamed and every new piece
+        of text is passed to it as soon as it arrives. The full response is
+        returned in both modes. Setting cancel_event abandons a stream.
+        """
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": max_tokens or MAX_COMPLETION_TOKENS,
+            **self.params
+        }
+        if on_token:
+            payload["stream"] = True
+        
+        # A cancellable call reads the body as a stream too, so cancelling can close it
+        cancellable = isinstance(cancel_event, CancelEvent)
+        abort = None
+        try:
+            response = get_http_session().post(
+                self.url,
+                headers=headers,
+                json=payload,
+                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                stream=bool(on_token) or cancellable
+            )
+            if cancellable:
+                # Cancelling closes the response, so a stalled read doesn't hold this thread
+                abort = lambda: abort_response(response)
+                cancel_event.add_callback(abort)
+            response.raise_for_status()
+            
+            if on_token:
+                return read_sse_stream(response, on_token, cancel_event)
+            
+            result = response.json()
+            if 'choices' in result and len(result['choices']) > 0:
+                return result['choices'][0]['message']['content'].strip()
+            else:
+                return "Error: No response content received from the API."
+                
+        except requests.exceptions.Timeout:
+            return "Error: Request timed out. Please try again."
+        except requests.exceptions.ConnectionError:
+            return "Error: Unable to connect to the API. Please check your internet connection."
+        except requests.exceptions.HTTPError as e:
+            if response.status_code == 401:
+                return "Error: Invalid API key. Please check your credentials."
+            elif response.status_code == 429:
+                return "Error: Rate limit exceeded. Please wait before trying again."
+            else:
+                return f"Error: API request failed with status {response.status_code}."
+        except requests.exceptions.RequestException as e:
+            return f"Error: Request failed - {str(e)}"
+        except json.JSONDecodeError:
+            return "Error: Invalid response format from API."
+        except Exception as e:
+            return f"Error: An unexpected error occurred - {str(e)}"
+        finally:
+            if abort is not None:
+                cancel_event.remove_callback(abort)
+
+class TogetherBackend(OpenAICompatibleBackend):
+    """Together.ai's OpenAI-compatible endpoint, with its extra sampling parameters"""
+    
+    name = "together"
+    api_key_env = "TOGETHER_API_KEY"
+    
+    def __init__(self, url=TOGETHER_API_URL, model=TOGETHER_MODEL):
+        super().__init__(url, model, extra_params=TOGETHER_GENERATION_PARAMS)
+
+class FakeBackend:
+    """Deterministic offline backend for load tests and benchmarks
+
+    Waits `latency` seconds, then emits `response_tokens` words at
+    `tokens_per_sec`. The text only depends on the messages, so cache and
+    coalescing behaviour is the same as with a real model, and everything
+    measured on top of it is the app's own overhead.
+    """
+    
+    name = "fake"
+    api_key_env = None
+    
+    def __init__(self, latency=FAKE_LLM_LATENCY, tokens_per_sec=FAKE_LLM_TOKENS_PER_SEC,
+                 response_tokens=FAKE_LLM_RESPONSE_TOKENS):
+        self.model = "fake"
+        self.params = {}
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.response_tokens = response_tokens
+    
+    def complete(self, messages, api_key, on_token=None, max_tokens=None, cancel_event=None):
+        """Return a canned completion after simulating the model's latency"""
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+        count = min(self.response_tokens, max_tokens or MAX_COMPLETION_TOKENS)
+        words = [f"{digest[:8]}:" if i == 0 else f"word{int(digest[i % 64], 16)}" for i in range(count)]
+        
+        time.sleep(self.latency)
+        delay = 1 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0
+        if not on_token:
+            time.sleep(delay * count)
+            return " ".join(words)
+        for i, word in enumerate(words):
+            time.sleep(delay)
+            if cancel_event is not None and cancel_event.is_set():
+                return "Error: Request cancelled."
+            on_token(word if i == 0 else " " + word)
+        return " ".join(words)
+
+class CircuitBreaker:
+    """Stops calls to a backend that keeps failing
+
+    After failure_threshold consecutive failures the circuit opens and
+    allow() refuses calls for reset_timeout seconds. Then a single trial
+    call is let through: success closes the circuit, failure reopens it.
+    """
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.time() - self.opened_at < self.reset_timeout:
+                return "open"
+            return "half-open"
+    
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+    
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._trial_running = False
+    
+    def release_trial(self):
+        """Let another trial call through when one was abandoned without a verdict"""
+        with self._lock:
+            self._trial_running = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self._trial_running or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self._trial_running = False
+
+class HedgedBackend:
+    """Wraps the primary backend with a circuit breaker and an optional hedge
+
+    When the primary's first token takes longer than the HEDGE_PERCENTILE of
+    its recent first-token latencies, the same request is also sent to the
+    secondary backend. Whichever streams first wins and the other is
+    cancelled (its response is closed, so a stalled read ends at once); a
+    primary that loses still adds the time it had taken so far to its
+    latencies, so the slow tail isn't dropped. A failed or circuit-broken
+    primary fails over to the secondary straight away.
+    """
+    
+    def __init__(self, primary, secondary=None, percentile=95, default_delay=3.0, min_delay=0.5,
+                 failure_threshold=5, reset_timeout=30.0, samples=200):
+        self.primary = primary
+        self.secondary = secondary
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.breakers = {
+            id(backend): CircuitBreaker(failure_threshold, reset_timeout)
+            for backend in (primary, secondary) if backend is not None
+        }
+        self.first_token_latencies = deque(maxlen=samples)
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self._lock = threading.Lock()
+    
+    # Cache keys and API key lookups follow the primary backend
+    name = property(lambda self: self.primary.name)
+    model = property(lambda self: self.primary.model)
+    params = property(lambda self: self.primary.params)
+    api_key_env = property(lambda self: self.primary.api_key_env)
+    
+    def hedge_delay(self):
+        """Seconds to wait for the primary's first token before hedging"""
+        with self._lock:
+            samples = sorted(self.first_token_latencies)
+        if len(samples) < 20:
+            return self.default_delay
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(self.min_delay, samples[index])
+    
+    def stats(self):
+        return {
+            "hedge_delay": self.hedge_delay(),
+            "hedges_sent": self.hedges_sent,
+            "hedges_won": self.hedges_won,
+            "circuits": {
+                backend.name: self.breakers[id(backend)].state
+                for backend in (self.primary, self.secondary) if backend is not None
+            }
+        }
+    
+    def metric_samples(self):
+        stats = self.stats()
+        samples = [
+            ("cognitype_llm_hedges_sent_total", "counter", {}, stats["hedges_sent"]),
+            ("cognitype_llm_hedges_won_total", "counter", {}, stats["hedges_won"]),
+            ("cognitype_llm_hedge_delay_seconds", "gauge", {}, round(stats["hedge_delay"], 6)),
+        ]
+        for backend, state in stats["circuits"].items():
+            for name in ("closed", "open", "half-open"):
+                samples.append((
+                    "cognitype_llm_circuit_state", "gauge", {"backend": backend, "state": name},
+                    int(state == name)
+                ))
+        return samples
+    
+    def _record(self, backend, result, cancelled):
+        breaker = self.breakers[id(backend)]
+        if cancelled:
+            breaker.release_trial()
+        elif result.startswith("Error:"):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    
+    def complete(self, messages, api_key, on_token=None, max_tokens=None, cancel_event=None):
+        """Return the first successful completion from the primary or the hedge"""
+        primary_allowed = self.breakers[id(self.primary)].allow()
+        
+        if self.secondary is None:
+            if not primary_allowed:
+                return "Error: The AI service is temporarily unavailable. Please try again shortly."
+            result = self.primary.complete(messages, api_key, on_token=on_token, max_tokens=max_tokens)
+            self._record(self.primary, result, cancelled=False)
+            return result
+        
+        # Attempts stream into one queue and the decisions are all made on this thread
+        ctx = get_script_run_ctx()
+        events = queue.Queue()
+        attempts = []
+        
+        def run(index, backend, key, cancel):
+            add_script_run_ctx(threading.current_thread(), ctx)
+            try:
+                result = backend.complete(
+                    messages, key, max_tokens=max_tokens, cancel_event=cancel,
+                    on_token=lambda text: events.put(("token", index, text))
+                )
+            except Exception as e:
+                result = f"Error: An unexpected error occurred - {str(e)}"
+            # Recorded here because a cancelled loser finishes after complete() has returned
+            self._record(backend, result, cancel.is_set())
+            events.put(("done", index, result))
+        
+        def start(backend, key):
+            attempt = {"backend": backend, "cancel": CancelEvent(), "started": time.time(), "done": False}
+            attempts.append(attempt)
+            # A thread of its own rather than a shared pool: a stalled attempt must not
+            # delay the start of other requests (the governor already caps how many run)
+            threading.Thread(
+                target=run, args=(len(attempts) - 1, backend, key, attempt["cancel"]),
+                name="llm-hedge", daemon=True
+            ).start()
+        
+        def secondary_key():
+            return os.getenv(self.secondary.api_key_env, "") if self.secondary.api_key_env else ""
+        
+        hedge_available = True
+        if primary_allowed:
+            start(self.primary, api_key)
+        elif self.breakers[id(self.secondary)].allow():
+            start(self.secondary, secondary_key())
+            hedge_available = False
+        else:
+            return "Error: The AI service is temporarily unavailable. Please try again shortly."
+        
+        deadline = time.time() + self.hedge_delay()
+        winner = None
+        running = 1
+        last_error = "Error: No response content received from the API."
+        
+        def record_primary_latency(final):
+            # A primary that lost to the hedge still counts: its first token would have taken
+            # at least this long, and leaving the slow tail out would drag the hedge delay down
+            for attempt in attempts:
+                if attempt["backend"] is self.primary and (final or not attempt["done"]):
+                    with self._lock:
+                        self.first_token_latencies.append(time.time() - attempt["started"])
+        
+        def hedge():
+            if not self.breakers[id(self.secondary)].allow():
+                return False
+            start(self.secondary, secondary_key())
+            with self._lock:
+                self.hedges_sent += 1
+            return True
+        
+        while running:
+            timeout = None
+            if winner is None and hedge_available:
+                timeout = max(0.0, deadline - time.time())
+            try:
+                kind, index, value = events.get(timeout=timeout)
+            except queue.Empty:
+                hedge_available = False
+                running += hedge()
+                continue
+            
+            attempt = attempts[index]
+            if kind == "token":
+                if winner is None:
+                    winner = index
+                    for other in attempts:
+                        if other is not attempt:
+                            other["cancel"].set()
+                    if attempt["backend"] is self.primary:
+                        record_primary_latency(final=True)
+                    elif len(attempts) > 1:
+                        record_primary_latency(final=False)
+                        with self._lock:
+                            self.hedges_won += 1
+                if index == winner and on_token:
+                    on_token(value)
+                continue
+            
+            running -= 1
+            attempt["done"] = True
+            if winner is None and not value.startswith("Error:") and attempt["backend"] is not self.primary:
+                # The hedge answered without streaming
+                record_primary_latency(final=False)
+            if index == winner or (winner is None and not value.startswith("Error:")):
+                for other in attempts:
+                    if other is not attempt:
+                        other["cancel"].set()
+                return value
+            if winner is None:
+                # Fail over instead of waiting out the hedge delay
+                last_error = value
+                if hedge_available:
+                    hedge_available = False
+                    running += hedge()
+        
+        return last_error
+
+def create_llm_backend(kind, model=None):
+    """Create a backend by name: together, openai or fake"""
+    if kind == "openai":
+        return OpenAICompatibleBackend(OPENAI_API_URL, model or OPENAI_MODEL)
+    if kind == "fake":
+        return FakeBackend()
+    return TogetherBackend(model=model or TOGETHER_MODEL)
+
+@st.cache_resource(show_spinner=False)
+def get_llm_backend():
+    """Create the LLM backend selected by LLM_BACKEND, shared by all sessions"""
+    secondary = None
+    if LLM_FALLBACK_BACKEND:
+        secondary = create_llm_backend(LLM_FALLBACK_BACKEND, LLM_FALLBACK_MODEL or None)
+    backend = HedgedBackend(
+        create_llm_backend(LLM_BACKEND),
+        secondary,
+        percentile=HEDGE_PERCENTILE,
+        default_delay=HEDGE_DEFAULT_DELAY,
+        min_delay=HEDGE_MIN_DELAY,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=CIRCUIT_RESET_TIMEOUT
+    )
+    get_metrics().add_collector("llm_backend", backend.metric_samples)
+    return backend
+
+def call_llm_api(prompt, api_key, on_token=None, max_tokens=None):
+    """Send a prompt to the configured LLM backend
+
+    prompt is either a list of chat messages or a single user message.
+    """
+    messages = prompt if isinstance(prompt, list) else [
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+    return get_llm_backend().complete(messages, api_key, on_token=on_token, max_tokens=max_tokens)
+
+class LLMTrafficGovernor:
+    """Shapes outbound LLM traffic before it reaches the shared API key
+
+    Each user has a token bucket (rate per minute with a small burst), and a
+    global cap limits concurrent upstream calls. Requests over the cap wait
+    in a first-come-first-served queue and can report their position.
+    """
+    
+    def __init__(self, max_concurrency=8, rate_per_minute=10.0, burst=3, max_wait=30.0):
+        self.max_concurrency = max_concurrency
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._queue = deque()  # tickets waiting for a concurrency slot, in arrival order
+        self._active = 0
+        self._buckets = OrderedDict()  # user_id -> [tokens, last refill time]
+        self.counters = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_rate_limit": 0,
+            "rejected_busy": 0,
+            "wait_seconds_total": 0.0
+        }
+    
+    def acquire(self, user_id, on_wait=None):
+        """Wait for permission to call the LLM; returns 'ok', 'rate_limited' or 'busy'
+
+        on_wait(position) is called while waiting: 0 while the user's own rate
+        limit is refilling, then the 1-based place in the global queue.
+        """
+        started = time.time()
+        
+        # Per-user token bucket - reserve a token, waiting for the refill if needed
+        with self._cond:
+            delay = self._reserve_token(user_id)
+            if delay > self.max_wait:
+                self._return_token(user_id)
+                self.counters["rejected_rate_limit"] += 1
+                return "rate_limited"
+        if delay > 0:
+            if on_wait:
+                on_wait(0)
+            time.sleep(delay)
+        
+        # Global concurrency cap with a fair FIFO queue
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            last_position = None
+            while self._queue[0] is not ticket or self._active >= self.max_concurrency:
+                if last_position is None:
+                    self.counters["queued"] += 1
+                remaining = self.max_wait - (time.time() - started)
+                if remaining <= 0:
+                    self._queue.remove(ticket)
+                    self._cond.notify_all()
+                    self.counters["rejected_busy"] += 1
+                    return "busy"
+                position = self._queue.index(ticket) + 1
+                if on_wait and position != last_position:
+                    # Callbacks may touch the UI - don't hold the lock while they run
+                    self._cond.release()
+                    try:
+                        on_wait(position)
+                    finally:
+                        self._cond.acquire()
+                last_position = position
+                self._cond.wait(timeout=min(remaining, 0.5))
+            
+            self._queue.popleft()
+            self._active += 1
+            self.counters["admitted"] += 1
+            self.counters["wait_seconds_total"] += time.time() - started
+            self._cond.notify_all()
+        return "ok"
+    
+    def release(self):
+        """Free the concurrency slot taken by a successful acquire()"""
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+    
+    def stats(self):
+        """Counters plus current queue depth and in-flight calls"""
+        with self._cond:
+            return dict(self.counters, waiting=len(self._queue), active=self._active)
+    
+    def metric_samples(self):
+        stats = self.stats()
+        return [
+            ("cognitype_llm_admitted_total", "counter", {}, stats["admitted"]),
+            ("cognitype_llm_queued_total", "counter", {}, stats["queued"]),
+            ("cognitype_llm_rejected_total", "counter", {"reason": "rate_limit"}, stats["rejected_rate_limit"]),
+            ("cognitype_llm_rejected_total", "counter", {"reason": "busy"}, stats["rejected_busy"]),
+            ("cognitype_llm_queue_wait_seconds_total", "counter", {}, round(stats["wait_seconds_total"], 6)),
+            ("cognitype_llm_queue_waiting", "gauge", {}, stats["waiting"]),
+            ("cognitype_llm_active_calls", "gauge", {}, stats["active"]),
+        ]
+    
+    def _reserve_token(self, user_id):
+        now = time.time()
+        tokens, refilled_at = self._buckets.pop(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - refilled_at) * self.rate) - 1
+        self._buckets[user_id] = [tokens, now]
+        # Forget the least recently seen users so the table stays bounded
+        while len(self._buckets) > 100000:
+            self._buckets.popitem(last=False)
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+    
+    def _return_token(self, user_id):
+        self._buckets[user_id][0] += 1
+
+@st.cache_resource(show_spinner=False)
+def get_llm_governor():
+    """Create the traffic governor shared by all sessions"""
+    governor = LLMTrafficGovernor(
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        rate_per_minute=LLM_RATE_PER_MINUTE,
+        burst=LLM_RATE_BURST,
+        max_wait=LLM_MAX_QUEUE_WAIT
+    )
+    get_metrics().add_collector("llm_governor", governor.metric_samples)
+    return governor
+
+class InFlightCall:
+    """One upstream LLM call that several requests are waiting on"""
+    
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._tokens = []
+        self._done = False
+        self._response = None
+    
+    def publish(self, text):
+        """Pass a streamed token on to the followers"""
+        with self._cond:
+            self._tokens.append(text)
+            self._cond.notify_all()
+    
+    def finish(self, response):
+        with self._cond:
+            self._done = True
+            self._response = response
+            self._cond.notify_all()
+    
+    def follow(self, on_token=None):
+        """Wait for the call's response, streaming its tokens to on_token
+
+        Tokens streamed before joining are replayed first as one piece.
+        Returns None when the leader gave up without calling upstream.
+        """
+        seen = 0
+        while True:
+            with self._cond:
+                while seen == len(self._tokens) and not self._done:
+                    self._cond.wait()
+                text = "".join(self._tokens[seen:])
+                seen = len(self._tokens)
+                done, response = self._done, self._response
+            if text and on_token:
+                on_token(text)
+            if done:
+                return response
+
+class SingleFlight:
+    """Coalesces identical in-flight LLM calls
+
+    The first request for a key becomes the leader and makes the upstream
+    call; requests for the same key arriving while it runs follow it and get
+    its tokens and response instead of calling upstream themselves. Keys are
+    only shared while the call is in flight, so unlike the response cache
+    this also helps for answers that must never be reused later.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def join(self, key):
+        """The in-flight call for key and whether the caller leads it"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = InFlightCall()
+            return call, True
+    
+    def finish(self, key, call, response):
+        """Hand the leader's response (None if it never called upstream) to the followers"""
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.finish(response)
+
+@st.cache_resource(show_spinner=False)
+def get_inflight_calls():
+    """Create the in-flight call registry shared by all sessions"""
+    return SingleFlight()
+
+class ResponseCache:
+    """Bounded in-process LRU cache for LLM responses with TTL expiry"""
+    
+    def __init__(self, max_entries=1000, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+    
+    def get(self, key):
+        """Return the cached response for key, or None on a miss"""
+        with self._lock:
+            value = self._load(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+    
+    def set(self, key, value):
+        """Store a response, evicting the least recently used entries"""
+        with self._lock:
+            self._store(key, value)
+    
+    def stats(self):
+        """Hit/miss counters for monitoring"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": self._size()}
+    
+    def metric_samples(self):
+        stats = self.stats()
+        return [
+            ("cognitype_cache_hits_total", "counter", {"cache": "response"}, stats["hits"]),
+            ("cognitype_cache_misses_total", "counter", {"cache": "response"}, stats["misses"]),
+            ("cognitype_cache_entries", "gauge", {"cache": "response"}, stats["size"]),
+        ]
+    
+    def _load(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, stored_at = entry
+        if time.time() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def _store(self, key, value):
+        self._entries[key] = (value, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def _size(self):
+        return len(self._entries)
+
+class SQLiteResponseCache(ResponseCache):
+    """On-disk response cache that survives restarts and is shared by worker processes"""
+    
+    def __init__(self, path, max_entries=1000, ttl=86400):
+        super().__init__(max_entries=max_entries, ttl=ttl)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+    
+    def _load(self, key):
+        row = self._conn.execute("SELECT value, stored_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > self.ttl:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+            return None
+        self._conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        return row[0]
+    
+    def _store(self, key, value):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, stored_at, used_at) VALUES (?, ?, ?, ?)",
+            (key, value, now, now)
+        )
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        self._conn.commit()
+    
+    def _size(self):
+        return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache():
+    """Create the semantic cache shared by all sessions (None when switched off)"""
+    if not SEMANTIC_CACHE or SEMANTIC_CACHE_MAX_ENTRIES <= 0:
+        return None
+    cache = SemanticCache(
+        create_embedder(SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_DIM),
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl=SEMANTIC_CACHE_TTL
+    )
+    get_metrics().add_collector("semantic_cache", cache.metric_samples)
+    return cache
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Create the response cache shared by all sessions (None when disabled)"""
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        cache = SQLiteResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+    elif RESPONSE_CACHE_BACKEND == "memory":
+        cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+    else:
+        return None
+    get_metrics().add_collector("response_cache", cache.metric_samples)
+    return cache
+
+def encode_chat_turn(turn):
+    """Serialize one turn compactly: a positional JSON row (see ConversationTurn.to_row), zlib-compressed"""
+    return zlib.compress(json.dumps(turn.to_row(), separators=(",", ":"), ensure_ascii=False).encode('utf-8'))
+
+def decode_chat_turn(blob):
+    return ConversationTurn(*json.loads(zlib.decompress(blob).decode('utf-8')))
+
+class ChatStateStore:
+    """Keeps each browser's chat (history and multi-turn summary) between sessions
+
+    A chat is stored as a small header (its first and next turn index, the
+    summary and a revision) plus one row per turn, so saving after an answer
+    only writes the new turns. Only the newest max_turns turns of a chat are
+    kept. Tabs of one browser share a chat: a save names the revision it
+    builds on and is refused if another tab saved since, so no tab silently
+    overwrites the other's turns.
+
+    This in-process store survives page reloads and reconnects; it keeps the
+    turns a session holds in memory (HISTORY_MEMORY_TURNS). The SQLite and
+    Redis stores also survive restarts and are shared by all replicas.
+    """
     
-    /* Chat Interface */
-    .chat-container {
-        background: #f8fafc;
-        border-radius: 15px;
-        padding: 1.5rem;
-        margin: 1rem 0;
-        border: 1px solid #e2e8f0;
-        position: relative;
-    }
+    def __init__(self, ttl=604800, max_entries=1000, max_turns=20):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_turns = max_turns
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
     
-    .chat-message {
-        background: white;
-        padding: 1rem;
-        border-radius: 10px;
-        margin: 0.5rem 0;
-        box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-        border-left: 4px solid #667eea;
-    }
+    def load(self, key):
+        """Return the saved chat state for key (with its 'revision'), or None"""
+        with self._lock:
+            header = self._load_header(key)
+            if header is None or header.get("v") != 3:
+                return None
+            blobs = self._load_turns(key, header["first"], header["next"])
+        # Restored turns keep their absolute indices
+        history = new_conversation_history(header["first"])
+        for index in range(header["first"], header["next"]):
+            if index in blobs:
+                history.append(decode_chat_turn(blobs[index]))
+            else:
+                # A turn went missing - restore only the turns after it
+                history = new_conversation_history(index + 1)
+        return {
+            "history": history,
+            "summary_lines": header["summary_lines"],
+            "summarized_turns": header["summarized_turns"],
+            "revision": header["revision"]
+        }
     
-    .user-message {
-        background: #e2e8f0;
-        color: #2d3748;
-        border-left: 4px solid #667eea;
-    }
+    def save(self, key, state, saved_turns=0, revision=None):
+        """Save a chat state ({'history', 'summary_lines', 'summarized_turns'})
+
+        Only the turns from index saved_turns on are written (all of them
+        when the history is shorter, i.e. it was cleared). revision is the
+        one this state was loaded or last saved at (0: nothing stored yet);
+        None overwrites unconditionally. Returns the number of turns saved
+        and the new revision, to pass next time - or None, writing nothing,
+        when another session has saved the chat since that revision.
+        """
+        history = state["history"]
+        next_index = len(history)
+        first = max(history.first, next_index - self.max_turns)
+        start = first if saved_turns > next_index else max(saved_turns, first)
+        turns = {index: encode_chat_turn(history[index]) for index in range(start, next_index)}
+        with self._lock, self._transaction(key):
+            old = self._load_header(key)
+            if old is not None and old.get("v") != 3:
+                old = None
+            stored_revision = old["revision"] if old else 0
+            if revision is not None and revision != stored_revision:
+                return None
+            header = {
+                "v": 3,
+                "revision": stored_revision + 1,
+                "first": first,
+                "next": next_index,
+                "summary_lines": state["summary_lines"],
+                "summarized_turns": state["summarized_turns"]
+            }
+            stale = [] if old is None else \
+                [index for index in range(old["first"], old["next"]) if not first <= index < next_index]
+            if not self._store(key, header, turns, stale):
+                return None
+        return next_index, header["revision"]
     
-    .ai-message {
-        background: #f8f9fa;
-        color: #2d3748;
-        border-left: 4px solid #667eea;
-        border: 1px solid #e2e8f0;
-    }
+    def _transaction(self, key):
+        # The lock held by save() is enough within one process
+        return nullcontext()
     
-    /* Chat save button positioning */
-    .chat-save-button {
-        position: absolute;
-        top: 1rem;
-        right: 1rem;
-        z-index: 10;
-    }
+    def _load_header(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        header, _, stored_at = entry
+        if time.time() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return header
     
-    /* Purple styling for save buttons */
-    .chat-container .stButton > button {
-        background: linear-gradient(135deg, #8b5cf6 0%, #a855f7 100%) !important;
-        color: white !important;
-        border: none !important;
-        border-radius: 8px !important;
-        padding: 0.4rem 0.8rem !important;
-        font-size: 0.85rem !important;
-        font-weight: 600 !important;
-        transition: all 0.2s ease !important;
-        box-shadow: 0 2px 8px rgba(139, 92, 246, 0.3) !important;
-        min-height: 36px !important;
-        cursor: pointer !important;
-        position: relative !important;
-        z-index: 100 !important;
-        pointer-events: auto !important;
-    }
+    def _load_turns(self, key, start, end):
+        return self._entries[key][1]
     
-    .chat-container .stButton > button:hover {
-        background: linear-gradient(135deg, #7c3aed 0%, #9333ea 100%) !important;
-        transform: translateY(-1px) !important;
-        box-shadow: 0 4px 12px rgba(139, 92, 246, 0.4) !important;
-        cursor: pointer !important;
-    }
+    def _store(self, key, header, turns, stale):
+        entry = self._entries.get(key)
+        rows = entry[1] if entry else {}
+        for index in stale:
+            rows.pop(index, None)
+        rows.update(turns)
+        self._entries[key] = (header, rows, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return True
+
+class SQLiteChatStateStore(ChatStateStore):
+    """On-disk chat state that survives restarts and is shared by processes on one host"""
     
-    .chat-container .stButton > button:disabled {
-        background: rgba(100, 100, 100, 0.3) !important;
-        color: #999 !important;
-        transform: none !important;
-        box-shadow: none !important;
-        cursor: not-allowed !important;
-    }
+    def __init__(self, path, ttl=604800, max_turns=500):
+        super().__init__(ttl=ttl, max_turns=max_turns)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_state "
+            "(key TEXT PRIMARY KEY, value BLOB NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_turns "
+            "(key TEXT NOT NULL, idx INTEGER NOT NULL, value BLOB NOT NULL, PRIMARY KEY (key, idx))"
+        )
+        self._conn.commit()
     
-    /* Fix button container */
-    .chat-container .stButton {
-        z-index: 100 !important;
-        position: relative !important;
-    }
+    @contextmanager
+    def _transaction(self, key):
+        # BEGIN IMMEDIATE takes the write lock before the header is read, so the
+        # revision check and the write are atomic across processes
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
     
-    /* Button Styling for main buttons */
-    .stButton > button {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%) !important;
-        color: white !important;
-        border: none !important;
-        border-radius: 25px !important;
-        padding: 0.75rem 2rem !important;
-        font-weight: 600 !important;
-        transition: all 0.3s ease !important;
-        box-shadow: 0 4px 15px rgba(102, 126, 234, 0.3) !important;
-        cursor: pointer !important;
-        z-index: 10 !important;
-        position: relative !important;
-    }
+    def _load_header(self, key):
+        row = self._conn.execute("SELECT value, stored_at FROM chat_state WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            # Written by an older version that stored the whole chat in one blob
+            return None
     
-    .stButton > button:hover {
-        transform: translateY(-2px) !important;
-        box-shadow: 0 8px 25px rgba(102, 126, 234, 0.4) !important;
-        cursor: pointer !important;
-    }
+    def _load_turns(self, key, start, end):
+        rows = self._conn.execute(
+            "SELECT idx, value FROM chat_turns WHERE key = ? AND idx >= ? AND idx < ?", (key, start, end)
+        )
+        return dict(rows.fetchall())
     
-    /* Animation for loading */
-    .loading-animation {
-        display: flex;
-        justify-content: center;
-        align-items: center;
-        padding: 2rem;
-    }
+    def _store(self, key, header, turns, stale):
+        now = time.time()
+        self._conn.executemany("DELETE FROM chat_turns WHERE key = ? AND idx = ?", [(key, index) for index in stale])
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO chat_turns (key, idx, value) VALUES (?, ?, ?)",
+            [(key, index, blob) for index, blob in turns.items()]
+        )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO chat_state (key, value, stored_at) VALUES (?, ?, ?)",
+            (key, json.dumps(header, separators=(",", ":"), ensure_ascii=False), now)
+        )
+        self._conn.execute(
+            "DELETE FROM chat_turns WHERE key IN (SELECT key FROM chat_state WHERE stored_at < ?)", (now - self.ttl,)
+        )
+        self._conn.execute("DELETE FROM chat_state WHERE stored_at < ?", (now - self.ttl,))
+        return True
+
+class RedisChatStateStore(ChatStateStore):
+    """Chat state in Redis (or any Redis-compatible server), shared by every replica
+
+    The header is a string key and the turns a hash of index -> row next to it.
+    A save WATCHes the header, so a concurrent save from another replica
+    makes it fail instead of interleaving.
+    """
     
-    .loading-dots {
-        display: inline-block;
-        position: relative;
-        width: 80px;
-        height: 80px;
-    }
+    def __init__(self, url, ttl=604800, max_turns=500):
+        import redis
+        super().__init__(ttl=ttl, max_turns=max_turns)
+        self._client = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+        self._pipe = None  # the pipeline of the save in progress (saves hold self._lock)
     
-    .loading-dots div {
-        position: absolute;
-        top: 33px;
-        width: 13px;
-        height: 13px;
-        border-radius: 50%;
-        background: #667eea;
-        animation-timing-function: cubic-bezier(0, 1, 1, 0);
-    }
+    @contextmanager
+    def _transaction(self, key):
+        with self._client.pipeline() as pipe:
+            pipe.watch(f"cognitype:chat:{key}")
+            self._pipe = pipe
+            try:
+                yield
+            finally:
+                self._pipe = None
     
-    .loading-dots div:nth-child(1) {
-        left: 8px;
-        animation: loading1 0.6s infinite;
-    }
+    def _load_header(self, key):
+        value = (self._pipe or self._client).get(f"cognitype:chat:{key}")
+        try:
+            return json.loads(value) if value else None
+        except ValueError:
+            # Written by an older version that stored the whole chat in one blob
+            return None
     
-    .loading-dots div:nth-child(2) {
-        left: 8px;
-        animation: loading2 0.6s infinite;
-    }
+    def _load_turns(self, key, start, end):
+        indices = list(range(start, end))
+        if not indices:
+            return {}
+        blobs = self._client.hmget(f"cognitype:chat:{key}:turns", indices)
+        return {index: blob for index, blob in zip(indices, blobs) if blob is not None}
     
-    .loading-dots div:nth-child(3) {
-        left: 32px;
-        animation: loading2 0.6s infinite;
-    }
+    def _store(self, key, header, turns, stale):
+        turns_key = f"cognitype:chat:{key}:turns"
+        pipe = self._pipe
+        pipe.multi()
+        if stale:
+            pipe.hdel(turns_key, *stale)
+        if turns:
+            pipe.hset(turns_key, mapping=turns)
+        pipe.set(f"cognitype:chat:{key}", json.dumps(header, separators=(",", ":"), ensure_ascii=False), ex=int(self.ttl))
+        pipe.expire(turns_key, int(self.ttl))
+        try:
+            pipe.execute()
+        except self._watch_error:
+            # Another replica saved this chat after we read its header
+            return False
+        return True
+
+@st.cache_resource(show_spinner=False)
+def get_chat_state_store():
+    """Create the chat state store shared by all sessions (None when disabled)"""
+    if STATE_BACKEND == "redis":
+        try:
+            return RedisChatStateStore(STATE_REDIS_URL, STATE_TTL, STATE_MAX_TURNS)
+        except ImportError:
+            # Chats would silently stop following users across replicas - say so
+            logging.getLogger(__name__).warning(
+                "STATE_BACKEND=redis but the redis package is not installed (pip install redis); "
+                "chats are kept in this process only"
+            )
+            return ChatStateStore(STATE_TTL, STATE_MAX_SESSIONS, HISTORY_MEMORY_TURNS)
+    if STATE_BACKEND == "sqlite":
+        return SQLiteChatStateStore(STATE_SQLITE_PATH, STATE_TTL, STATE_MAX_TURNS)
+    if STATE_BACKEND == "memory":
+        return ChatStateStore(STATE_TTL, STATE_MAX_SESSIONS, HISTORY_MEMORY_TURNS)
+    return None
+
+def save_chat_state(overwrite=False):
+    """Write this session's new turns and chat summary to the state store, keyed by the browser id
+
+    When another tab of the same browser has saved in between, its chat is
+    loaded and this session's unsaved turns are added after its turns.
+    overwrite (used by Clear) replaces whatever is stored.
+    """
+    store = get_chat_state_store()
+    browser_user_id = st.session_state.get('browser_user_id')
+    if store is None or not browser_user_id:
+        return
+    try:
+        for attempt in range(3):
+            saved = store.save(browser_user_id, {
+                "history": st.session_state.conversation_history,
+                "summary_lines": st.session_state.get('chat_summary_lines', []),
+                "summarized_turns": st.session_state.get('chat_summarized_turns', 0)
+            }, st.session_state.get('chat_saved_turns', 0),
+                None if overwrite else st.session_state.get('chat_state_revision', 0))
+            if saved is None:
+                merge_stored_chat(store.load(browser_user_id))
+                continue
+            st.session_state.chat_saved_turns, st.session_state.chat_state_revision = saved
+            return
+    except Exception:
+        # The chat still works for this session without the store
+        pass
+
+def merge_stored_chat(stored):
+    """Continue from the stored chat, followed by this session's turns that aren't saved yet"""
+    history = st.session_state.conversation_history
+    unsaved = range(max(st.session_state.get('chat_saved_turns', 0), history.first), len(history))
+    if stored is None:
+        # The stored chat is gone - the next save writes this session's history whole
+        st.session_state.chat_saved_turns = 0
+        st.session_state.chat_state_revision = 0
+        return
+    merged = stored["history"]
+    stored_turns = len(merged)
+    save_jobs = {}
+    for index in unsaved:
+        if index in st.session_state.save_jobs:
+            save_jobs[len(merged)] = st.session_state.save_jobs[index]
+        merged.append(history[index])
+    st.session_state.conversation_history = merged
+    st.session_state.save_jobs = save_jobs
+    st.session_state.chat_summary_lines = stored["summary_lines"]
+    st.session_state.chat_summarized_turns = stored["summarized_turns"]
+    st.session_state.chat_saved_turns = stored_turns
+    st.session_state.chat_state_revision = stored["revision"]
+
+def normalize_question(question):
+    """Normalize a question so trivially different spellings share a cache entry"""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+def response_cache_key(prompt, max_tokens, user_question):
+    """Cache key: hash of the assembled prompt with its question normalized, plus model settings"""
+    # Swap the question in the final message for its normalized form instead of assembling again
+    head, _, tail = prompt[-1]["content"].rpartition(user_question)
+    messages = prompt[:-1] + [dict(prompt[-1], content=head + normalize_question(user_question) + tail)]
+    backend = get_llm_backend()
+    material = json.dumps([backend.name, backend.model, backend.params, max_tokens, messages], sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def semantic_cache_scope(mbti_type):
+    """Questions only answer each other for the same type under the same model settings"""
+    backend = get_llm_backend()
+    return json.dumps([backend.name, backend.model, backend.params, mbti_type], sort_keys=True)
+
+def llm_call_key(prompt, max_tokens, api_key):
+    """Key for coalescing in-flight calls: hash of the exact prompt, model settings and API key"""
+    backend = get_llm_backend()
+    material = json.dumps(
+        [backend.name, backend.model, backend.params, max_tokens, prompt,
+         hashlib.sha256((api_key or "").encode('utf-8')).hexdigest()],
+        sort_keys=True
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def get_personalized_response(mbti_type, user_question, memory_context, api_key, on_token=None,
+                              use_cache=None, user_id=None, on_wait=None, chat_context=None):
+    """Get the chatbot's answer, serving it from the response cache when allowed
+
+    Only deterministic (temperature 0) or explicitly opted-in requests are
+    read from or written to the caches: the exact response cache, then the
+    semantic cache for rewordings of earlier questions. A request whose
+    exact prompt is already on its way upstream shares that call instead of
+    making its own. Upstream calls go through the traffic governor; on_wait
+    is passed on to report the user's place in its queue. chat_context
+    carries earlier turns in multi-turn mode.
+    """
+    metrics = get_metrics()
     
-    .loading-dots div:nth-child(4) {
-        left: 56px;
-        animation: loading3 0.6s infinite;
-    }
+    # Reject oversized prompts before spending any time on them upstream
+    try:
+        with metrics.timer("prompt_assembly"):
+            prompt, max_tokens = assemble_prompt(mbti_type, user_question, memory_context, chat_context)
+    except PromptTooLargeError:
+        metrics.inc("cognitype_responses_total", source="none", outcome="too_long")
+        return "Error: Your question is too long. Please shorten it and try again."
     
-    @keyframes loading1 {
-        0% { transform: scale(0); }
-        100% { transform: scale(1); }
-    }
+    if use_cache is None:
+        use_cache = GENERATION_PARAMS["temperature"] == 0 or RESPONSE_CACHE_OPT_IN
+    cache = get_response_cache() if use_cache else None
     
-    @keyframes loading3 {
-        0% { transform: scale(1); }
-        100% { transform: scale(0); }
-    }
+    cache_key = None
+    if cache is not None:
+        with metrics.timer("response_cache_lookup"):
+            cache_key = response_cache_key(prompt, max_tokens, user_question)
+            cached = cache.get(cache_key)
+        if cached is not None:
+            metrics.inc("cognitype_responses_total", source="cache", outcome="ok")
+            return cached
     
-    @keyframes loading2 {
-        0% { transform: translate(0, 0); }
-        100% { transform: translate(24px, 0); }
-    }
+    # Rewordings of an earlier question; personalized prompts are never shared this way
+    semantic_cache = None
+    earlier_turns = chat_context and (chat_context.get("summary") or chat_context.get("turns"))
+    if use_cache and not memory_context and not earlier_turns:
+        semantic_cache = get_semantic_cache()
+    if semantic_cache is not None:
+        with metrics.timer("semantic_cache_lookup"):
+            semantic_scope = semantic_cache_scope(mbti_type)
+            question_vector = semantic_cache.embed(user_question)
+            cached = semantic_cache.get(semantic_scope, question_vector)
+        if cached is not None:
+            metrics.inc("cognitype_responses_total", source="semantic_cache", outcome="ok")
+            return cached
     
-    /* Stats and info boxes */
-    .info-box {
-        background: linear-gradient(135deg, #ffecd2 0%, #fcb69f 100%);
-        padding: 1rem;
-        border-radius: 10px;
-        margin: 0.5rem 0;
-        color: #744210;
-        border-left: 4px solid #ed8936;
-    }
+    # Followers of an identical call already in flight don't go upstream (or through the governor)
+    inflight = get_inflight_calls() if LLM_COALESCE else None
+    call = None
+    if inflight is not None:
+        call_key = llm_call_key(prompt, max_tokens, api_key)
+        while True:
+            call, leader = inflight.join(call_key)
+            if leader:
+                break
+            with metrics.timer("llm_coalesced_wait"):
+                response = call.follow(on_token)
+            if response is not None:
+                metrics.inc(
+                    "cognitype_responses_total", source="coalesced",
+                    outcome="error" if response.startswith("Error:") else "ok"
+                )
+                return response
+            # The leader was turned away before calling upstream - take its place
     
-    /* Hide Streamlit default elements */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    header {visibility: hidden;}
-    
-    /* Hide sidebar completely */
-    .css-1d391kg {display: none !important;}
-    .css-1l02zno {display: none !important;}
-    section[data-testid="stSidebar"] {display: none !important;}
-    .stSidebar {display: none !important;}
-    
-    /* Hide custom scrollbar completely */
-    ::-webkit-scrollbar {
-        width: 0px !important;
-        background: transparent !important;
-    }
+    response = None
+    try:
+        governor = get_llm_governor()
+        with metrics.timer("llm_queue_wait"):
+            admission = governor.acquire(user_id or "anonymous", on_wait=on_wait)
+        if admission != "ok":
+            metrics.inc("cognitype_responses_total", source="none", outcome=admission)
+        if admission == "rate_limited":
+            return "Error: Rate limit exceeded. Please wait before trying again."
+        if admission == "busy":
+            return "Error: The server is busy right now. Please try again in a moment."
+        
+        # Time to first token is what the user feels when streaming
+        llm_started = time.perf_counter()
+        if on_token:
+            stream_to = on_token
+            first_token = [True]
+            
+            def on_token(text):
+                if first_token[0]:
+                    first_token[0] = False
+                    metrics.observe_stage("llm_first_token", time.perf_counter() - llm_started)
+                if call is not None:
+                    call.publish(text)
+                stream_to(text)
+        
+        try:
+            with metrics.timer("llm_call"):
+                response = call_llm_api(prompt, api_key, on_token=on_token, max_tokens=max_tokens)
+        finally:
+            governor.release()
+        metrics.inc(
+            "cognitype_responses_total", source="llm",
+            outcome="error" if response.startswith("Error:") else "ok"
+        )
+    finally:
+        if call is not None:
+            inflight.finish(call_key, call, response)
     
-    .chat-message strong {
-        font-family: 'Inter', sans-serif;
-        font-weight: 600;
-        font-size: 0.95rem;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-# Constants
-MBTI_TYPES = [
-    "INTJ", "INTP", "ENTJ", "ENTP",
-    "INFJ", "INFP", "ENFJ", "ENFP", 
-    "ISTJ", "ISFJ", "ESTJ", "ESFJ",
-    "ISTP", "ISFP", "ESTP", "ESFP"
-]
-
-MBTI_DESCRIPTIONS = {
-    "INTJ": "Architect - Strategic, analytical, and independent",
-    "INTP": "Thinker - Logical, innovative, and curious",
-    "ENTJ": "Commander - Confident, strategic, and natural leaders",
-    "ENTP": "Debater - Quick-witted, clever, and conceptual",
-    "INFJ": "Advocate - Creative, insightful, and principled",
-    "INFP": "Mediator - Idealistic, loyal, and values-driven",
-    "ENFJ": "Protagonist - Charismatic, inspiring, and natural leaders",
-    "ENFP": "Campaigner - Enthusiastic, creative, and sociable",
-    "ISTJ": "Logistician - Practical, fact-minded, and reliable",
-    "ISFJ": "Protector - Warm-hearted, conscientious, and cooperative",
-    "ESTJ": "Executive - Organized, practical, and decisive",
-    "ESFJ": "Consul - Caring, social, and popular",
-    "ISTP": "Virtuoso - Bold, practical, and experimental",
-    "ISFP": "Adventurer - Charming, sensitive, and artistic",
-    "ESTP": "Entrepreneur - Smart, energetic, and perceptive",
-    "ESFP": "Entertainer - Spontaneous, enthusiastic, and playful"
-}
+    # Never cache failures
+    if not response.startswith("Error:"):
+        if cache_key:
+            cache.set(cache_key, response)
+        if semantic_cache is not None:
+            semantic_cache.set(semantic_scope, question_vector, response)
+    return response
 
-MBTI_EMOJIS = {
-    "INTJ": "🏗️", "INTP": "🧠", "ENTJ": "👑", "ENTP": "💡",
-    "INFJ": "🌟", "INFP": "🎨", "ENFJ": "🎭", "ENFP": "🦋", 
-    "ISTJ": "📊", "ISFJ": "🛡️", "ESTJ": "⚡", "ESFJ": "🤝",
-    "ISTP": "🔧", "ISFP": "🌸", "ESTP": "��", "ESFP": "🎉"
-}
+def detach_script_run_ctx():
+    """Remove the session context attached to this pool thread (add_script_run_ctx can't set None)"""
+    if hasattr(threading.current_thread(), SCRIPT_RUN_CONTEXT_ATTR_NAME):
+        delattr(threading.current_thread(), SCRIPT_RUN_CONTEXT_ATTR_NAME)
 
-MBTI_FACTS = {
-    "INTJ": "INTJs make up only 2% of the population and are known as 'The Architects' - they excel at strategic planning and long-term vision!",
-    "INTP": "INTPs are natural theorists who love exploring complex ideas - they often become scientists, philosophers, or inventors!",
-    "ENTJ": "ENTJs are born leaders who make up 3% of the population - they're excellent at organizing people and resources to achieve goals!",
-    "ENTP": "ENTPs are innovative debaters who see possibilities everywhere - they're great at brainstorming and challenging conventional thinking!",
-    "INFJ": "INFJs are the rarest personality type (1% of population) - they have incredible intuition and often become counselors or writers!",
-    "INFP": "INFPs are idealistic mediators who are driven by their values - they often excel in creative fields and helping professions!",
-    "ENFJ": "ENFJs are natural teachers and mentors - they have an amazing ability to inspire and develop others' potential!",
-    "ENFP": "ENFPs are enthusiastic campaigners who bring energy to everything - they're excellent at connecting with people and generating ideas!",
-    "ISTJ": "ISTJs are reliable logisticians who value tradition and stability - they're the backbone of many organizations!",
-    "ISFJ": "ISFJs are caring protectors who remember details about people they care about - they're often found in healthcare and education!",
-    "ESTJ": "ESTJs are efficient executives who get things done - they're natural organizers and often become successful managers!",
-    "ESFJ": "ESFJs are warm-hearted consuls who create harmony in groups - they're excellent at reading social dynamics!",
-    "ISTP": "ISTPs are practical virtuosos who love working with their hands - they're great at troubleshooting and mechanical tasks!",
-    "ISFP": "ISFPs are gentle adventurers with strong aesthetic sense - they often excel in arts, music, or nature-related fields!",
-    "ESTP": "ESTPs are energetic entrepreneurs who live in the moment - they're great at crisis management and hands-on problem solving!",
-    "ESFP": "ESFPs are spontaneous entertainers who bring joy to others - they're natural performers and excellent at reading people's emotions!"
-}
+@st.cache_resource(show_spinner=False)
+def get_fanout_executor():
+    """Bounded worker pool shared by all sessions for compare-mode fan-out"""
+    return ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix="llm-fanout")
 
-def get_api_key():
-    """Get API key from environment variables"""
-    api_key = os.getenv("TOGETHER_API_KEY")
-    if not api_key:
-        st.error("⚠️ TOGETHER_API_KEY environment variable is not set!")
-        st.stop()
-    return api_key
+def fan_out_responses(mbti_types, user_question, memory_context, api_key, user_id=None, chat_context=None):
+    """Ask several personality types the same question concurrently
 
-def create_personalized_prompt(mbti_type, user_question, memory_context=""):
-    """Create a personalized prompt based on MBTI type and user memory"""
-    base_prompt = f"""You are an AI chatbot that has the {mbti_type} personality type ({MBTI_DESCRIPTIONS.get(mbti_type, '')}). 
-You are responding TO a user, not AS the user. You have the {mbti_type} cognitive preferences, communication style, and decision-making approach.
-Think and respond like someone with {mbti_type} personality would - with their strengths, perspectives, and communication patterns.
+    Yields (mbti_type, response) as each call completes, so the wall-clock
+    time is that of the slowest call rather than the sum of all of them.
+    """
+    ctx = get_script_run_ctx()
+    
+    def ask(mbti_type):
+        # Let cached resources and session lookups work on the worker thread
+        add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            return get_personalized_response(
+                mbti_type, user_question, memory_context, api_key,
+                user_id=user_id, chat_context=chat_context
+            )
+        finally:
+            # The pool thread is reused by other sessions
+            detach_script_run_ctx()
+    
+    futures = {get_fanout_executor().submit(ask, mbti_type): mbti_type for mbti_type in mbti_types}
+    for future in as_completed(futures):
+        try:
+            response = future.result()
+        except Exception as e:
+            response = f"Error: An unexpected error occurred - {str(e)}"
+        yield futures[future], response
 
-{memory_context}
+class InferenceJobQueue:
+    """Answers questions on a bounded worker pool shared by all sessions
 
-IMPORTANT: If the context from previous conversations contains information about the USER (like their occupation, interests, or personal details), reference that information when responding. You know this about the user from your previous conversations with them.
+    A session only keeps the job id in session state. The job keeps running
+    when the user clicks something and the script reruns, and the next run
+    picks up its progress (status message, streamed text, finished answers)
+    by id. Finished jobs are kept for result_ttl seconds.
+    """
+    
+    def __init__(self, max_workers=16, max_pending=200, result_ttl=600.0):
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # job id -> job state, in submission order
+    
+    def submit(self, task):
+        """Run task(job_id) on the pool and return the job id
 
-Instructions for your response:
-- Respond as a {mbti_type} personality type chatbot
-- Use the specific communication style and thinking patterns of {mbti_type}
-- Reference what you know about the USER from previous conversations
-- Give advice/opinions based on your {mbti_type} perspective
-- Be helpful while maintaining your {mbti_type} personality traits
+        Raises queue.Full when max_pending jobs are already queued or running.
+        """
+        with self._lock:
+            now = time.time()
+            for job_id, job in list(self._jobs.items()):
+                if job["finished_at"] is not None and now - job["finished_at"] > self.result_ttl:
+                    del self._jobs[job_id]
+            if sum(1 for job in self._jobs.values() if job["status"] != "done") >= self.max_pending:
+                raise queue.Full
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "status": "queued", "message": "", "chunks": [], "answers": {},
+                "version": 0, "finished_at": None
+            }
+        self._executor.submit(self._run, job_id, task, get_script_run_ctx())
+        return job_id
+    
+    def status(self, job_id):
+        """Snapshot of a job's progress, or None when the id is unknown or expired"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = {
+                "status": job["status"],
+                "message": job["message"],
+                "text": "".join(job["chunks"]),
+                "answers": dict(job["answers"]),
+                "version": job["version"],
+                "position": 0
+            }
+            if job["status"] == "queued":
+                queued = [jid for jid, other in self._jobs.items() if other["status"] == "queued"]
+                snapshot["position"] = queued.index(job_id) + 1
+            return snapshot
+    
+    def set_message(self, job_id, message):
+        self._update(job_id, lambda job: job.update(message=message))
+    
+    def stream(self, job_id, text):
+        self._update(job_id, lambda job: job["chunks"].append(text))
+    
+    def answer(self, job_id, mbti_type, response):
+        self._update(job_id, lambda job: job["answers"].__setitem__(mbti_type, response))
+    
+    def _update(self, job_id, change):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                change(job)
+                job["version"] += 1
+    
+    def _run(self, job_id, task, ctx):
+        # Let cached resources work on the worker thread
+        add_script_run_ctx(threading.current_thread(), ctx)
+        self._update(job_id, lambda job: job.update(status="running"))
+        try:
+            task(job_id)
+        except Exception as e:
+            self.set_message(job_id, f"Error: An unexpected error occurred - {str(e)}")
+        finally:
+            self._update(job_id, lambda job: job.update(status="done", finished_at=time.time()))
+            # The pool thread is reused by other sessions' jobs
+            detach_script_run_ctx()
 
-User's Question: {user_question}
+@st.cache_resource(show_spinner=False)
+def get_inference_jobs():
+    """Create the inference job queue shared by all sessions"""
+    return InferenceJobQueue(
+        max_workers=INFERENCE_WORKERS,
+        max_pending=INFERENCE_MAX_PENDING,
+        result_ttl=INFERENCE_RESULT_TTL
+    )
 
-Your response as a {mbti_type} chatbot:"""
-    return base_prompt
+def wait_for_memory_context(memory_future, submit_started):
+    """The user's memory context if it arrives within the latency budget, else empty"""
+    if memory_future is None:
+        return ""
+    try:
+        remaining = MEMORY_FETCH_BUDGET_MS / 1000 - (time.time() - submit_started)
+        with get_metrics().timer("memory_wait"):
+            memory_context = memory_future.result(timeout=max(remaining, 0))
+        return memory_context if memory_context and memory_context.strip() else ""
+    except FutureTimeoutError:
+        # Slow memory - answer without it; the late result still
+        # lands in the cache and is used next turn
+        return ""
+    except Exception:
+        # If memory fails, continue without it for speed (the cache has
+        # already reported the failure to the health tracker)
+        return ""
 
-def call_together_api(prompt, api_key):
-    """Make API call to Together.ai's Mistral-7B model"""
-    url = "https://api.together.xyz/v1/chat/completions"
+def answer_question(job_id, mbti_types, user_question, memory_future, submit_started, api_key,
+                    user_id=None, chat_context=None):
+    """Inference job: wait for memory, then answer as one type (streamed) or compare several"""
+    jobs = get_inference_jobs()
+    memory_context = wait_for_memory_context(memory_future, submit_started)
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+    if len(mbti_types) > 1:
+        for mbti_type, response in fan_out_responses(
+            mbti_types, user_question, memory_context, api_key,
+            user_id=user_id, chat_context=chat_context
+        ):
+            jobs.answer(job_id, mbti_type, response)
+        return
     
-    payload = {
-        "model": "mistralai/Mistral-7B-Instruct-v0.1",
-        "messages": [
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ],
-        "max_tokens": 512,
-        "temperature": 0.7,
-        "top_p": 0.7,
-        "top_k": 50,
-        "repetition_penalty": 1,
-        "stop": [""]
-    }
+    mbti_type = mbti_types[0]
+    if memory_context:
+        jobs.set_message(job_id, f"🧠 Crafting a personalized {mbti_type} response + using your memory...")
     
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        
-        result = response.json()
-        if 'choices' in result and len(result['choices']) > 0:
-            return result['choices'][0]['message']['content'].strip()
+    # Show the user's place in line when the shared LLM capacity is busy
+    def on_wait(position):
+        if position == 0:
+            jobs.set_message(job_id, "⏳ You're asking quickly - your question will be sent in a moment...")
         else:
-            return "Error: No response content received from the API."
-            
-    except requests.exceptions.Timeout:
-        return "Error: Request timed out. Please try again."
-    except requests.exceptions.ConnectionError:
-        return "Error: Unable to connect to the API. Please check your internet connection."
-    except requests.exceptions.HTTPError as e:
-        if response.status_code == 401:
-            return "Error: Invalid API key. Please check your credentials."
-        elif response.status_code == 429:
-            return "Error: Rate limit exceeded. Please wait before trying again."
+            jobs.set_message(job_id, f"⏳ Lots of people are chatting - you're #{position} in line...")
+    
+    # Make API call (served from the response cache when possible)
+    response = get_personalized_response(
+        mbti_type, user_question, memory_context, api_key,
+        on_token=(lambda text: jobs.stream(job_id, text)) if STREAM_RESPONSES else None,
+        user_id=user_id, on_wait=on_wait, chat_context=chat_context
+    )
+    jobs.answer(job_id, mbti_type, response)
+
+def inference_job_panel(active_job):
+    """Placeholders for a job's progress: one per personality type"""
+    mbti_types = active_job['mbti_types']
+    if len(mbti_types) > 1:
+        return {mbti_type: column.empty() for column, mbti_type in zip(st.columns(len(mbti_types)), mbti_types)}
+    return {mbti_types[0]: st.empty()}
+
+def render_inference_job(active_job, panel):
+    """Render a job's current progress into its panel and return its snapshot
+
+    Returns None when the job was lost.
+    """
+    job = get_inference_jobs().status(active_job['id'])
+    if job is None or job['status'] == "done":
+        return job
+    
+    for mbti_type, placeholder in panel.items():
+        if mbti_type in job['answers']:
+            placeholder.markdown(ai_message_html(mbti_type, job['answers'][mbti_type]), unsafe_allow_html=True)
+        elif len(panel) > 1:
+            placeholder.markdown(
+                loading_animation_html(f"{MBTI_EMOJIS[mbti_type]} {mbti_type} is thinking..."),
+                unsafe_allow_html=True
+            )
+        elif job['text']:
+            placeholder.markdown(ai_message_html(mbti_type, job['text']), unsafe_allow_html=True)
+        elif job['position']:
+            placeholder.markdown(
+                loading_animation_html(f"⏳ Waiting for a free worker - you're #{job['position']} in line..."),
+                unsafe_allow_html=True
+            )
         else:
-            return f"Error: API request failed with status {response.status_code}."
-    except requests.exceptions.RequestException as e:
-        return f"Error: Request failed - {str(e)}"
-    except json.JSONDecodeError:
-        return "Error: Invalid response format from API."
-    except Exception as e:
-        return f"Error: An unexpected error occurred - {str(e)}"
+            placeholder.markdown(
+                loading_animation_html(job['message'] or f"🧠 Crafting a personalized {mbti_type} response..."),
+                unsafe_allow_html=True
+            )
+    return job
+
+def follow_inference_job(active_job, panel, job):
+    """Keep a job's panel up to date until the job is done
+
+    Called at the end of the script, once the rest of the page is rendered,
+    so while the answer is written only the panel is sent again - every
+    INFERENCE_POLL_INTERVAL, and only when the job changed. Each check is a
+    Streamlit yield point: a click or a closed tab stops this run there, and
+    the click's run starts at once (fast reruns), so nothing waits behind
+    it. The job itself runs on the worker pool either way.
+    """
+    jobs = get_inference_jobs()
+    heartbeat = st.empty()
+    rendered = (job['version'], job['position'])
+    while True:
+        time.sleep(INFERENCE_POLL_INTERVAL)
+        status = jobs.status(active_job['id'])
+        if status is None or status['status'] == "done":
+            return
+        if (status['version'], status['position']) == rendered:
+            # Nothing new - an empty update is still a yield point
+            heartbeat.empty()
+            continue
+        job = render_inference_job(active_job, panel)
+        if job is None or job['status'] == "done":
+            return
+        rendered = (job['version'], job['position'])
+
+# Per-run stage timings (the whole script reruns on every interaction)
+script_run_started = time.perf_counter()
 
 # Initialize session state
 if 'conversation_history' not in st.session_state:
-    st.session_state.conversation_history = []
+    st.session_state.conversation_history = new_conversation_history()
 
 if 'clear_input' not in st.session_state:
     st.session_state.clear_input = False
 
-# Initialize Memobase
+# Initialize Memobase (one client per process, health checked in the background)
 if 'memobase_client' not in st.session_state:
-    st.session_state.memobase_client = init_memobase()
+    st.session_state.memobase_client = get_memobase_client()
+    if st.session_state.memobase_client is None:
+        st.warning("⚠️ Memobase API key not found. Memory features disabled.")
+
+if st.session_state.memobase_client and not memobase_available():
+    st.warning("⚠️ Could not connect to Memobase. Memory features disabled.")
 
 if 'memobase_user' not in st.session_state:
     st.session_state.memobase_user = None
 
+# localStorage values reported by the browser storage bridge (None until it answers)
+browser_storage_values = st.session_state.get("browser_storage")
+
+# localStorage writes sent to the browser with the bridge at the end of each run
+if 'storage_writes' not in st.session_state:
+    st.session_state.storage_writes = {}
+
+# The question being answered in the background ({'id', 'mbti_types', 'question', 'submitted'})
+if 'active_job' not in st.session_state:
+    st.session_state.active_job = None
+
+# Number of most recent conversations rendered in the chat history
+if 'history_visible' not in st.session_state:
+    st.session_state.history_visible = HISTORY_PAGE_SIZE
+
+# Background save job ids, keyed by conversation index
+if 'save_jobs' not in st.session_state:
+    st.session_state.save_jobs = {}
+
+# Stable browser id from localStorage (reported by the storage bridge); the
+# saved chat and the Memobase user are keyed by it, so a returning browser
+# gets both back
+if not st.session_state.get('browser_user_id'):
+    browser_user_id = get_browser_user_id(browser_storage_values)
+    if browser_user_id:
+        st.session_state.browser_user_id = browser_user_id
+
+# Restore this browser's chat from the state store (once per session)
+if st.session_state.get('browser_user_id') and not st.session_state.get('chat_state_loaded'):
+    st.session_state.chat_state_loaded = True
+    store = get_chat_state_store()
+    saved_chat = None
+    if store is not None and not st.session_state.conversation_history:
+        try:
+            saved_chat = store.load(st.session_state.browser_user_id)
+        except Exception:
+            saved_chat = None
+    if saved_chat:
+        st.session_state.conversation_history = saved_chat["history"]
+        st.session_state.chat_summary_lines = saved_chat["summary_lines"]
+        st.session_state.chat_summarized_turns = saved_chat["summarized_turns"]
+        st.session_state.chat_saved_turns = len(saved_chat["history"])
+        st.session_state.chat_state_revision = saved_chat["revision"]
+
 # Create or get Memobase user
-if st.session_state.memobase_client and st.session_state.memobase_user is None:
+if memobase_available() and st.session_state.memobase_user is None and st.session_state.get('browser_user_id'):
     try:
-        # Smart localStorage-based user management
-        
-        # Step 1: Get or create persistent browser user ID
-        browser_user_id = None
-        
-        # Initialize JavaScript to check localStorage
-        st.markdown("""
-        <script>
-        // Get or create browser user ID
-        let browserId = getBrowserIdFromLocalStorage();
-        if (!browserId) {
-            // Generate new browser ID
-            browserId = 'browser_' + Math.random().toString(36).substr(2, 9) + '_' + Date.now();
-            saveBrowserIdToLocalStorage(browserId);
-            console.log('Created new browser ID:', browserId);
-        } else {
-            console.log('Found existing browser ID:', browserId);
-        }
+        browser_user_id = st.session_state.browser_user_id
         
-        // Check if we have a Memobase mapping for this browser
-        const existingMemobaseId = getMemobaseMappingForBrowser(browserId);
-        
-        // Store data for Python to access
-        window.browserUserData = {
-            browserId: browserId,
-            existingMemobaseId: existingMemobaseId
-        };
-        
-        console.log('Browser-Memobase mapping:', browserId, '->', existingMemobaseId || 'none');
-        </script>
-        """, unsafe_allow_html=True)
-        
-        # Small delay to let JavaScript execute
-        time.sleep(0.1)
-        
-        # Generate unique user ID for this browser session
-        # Use browser fingerprint + timestamp for uniqueness
-        browser_fingerprint = f"browser_{uuid.uuid4().hex[:8]}_{int(time.time())}"
-        existing_memobase_id = None  # Will create new user each time for now
+        # Returning users come from the local cache without touching Memobase
+        st.session_state.memobase_user = get_or_create_memobase_user(
+            st.session_state.memobase_client,
+            browser_user_id
+        )
+        st.session_state.memobase_user_id = st.session_state.memobase_user.user_id
         
-        try:
-            # Always create new Memobase user to avoid lock conflicts
-            # In future, implement proper localStorage reading for persistence
-            uid = st.session_state.memobase_client.add_user({
-                "app": "cognitype_chatbot",
-                "created_at": datetime.now().isoformat(),
-                "session_type": "persistent_browser",
-                "browser_fingerprint": browser_fingerprint
-            })
-            
-            st.session_state.memobase_user_id = uid
-            st.session_state.memobase_user = st.session_state.memobase_client.get_user(uid)
-            
-            # Save the browser -> memobase mapping
-            st.markdown(f"""
-            <script>
-            const browserId = window.browserUserData ? window.browserUserData.browserId : getBrowserIdFromLocalStorage();
-            if (browserId) {{
-                saveMemobaseMappingForBrowser(browserId, '{uid}');
-                console.log('Created new Memobase user and saved mapping:', browserId, '->', '{uid}');
-            }}
-            </script>
-            """, unsafe_allow_html=True)
-            
-        except Exception as e:
-            # Could not create user - continue silently
-            pass
-
     except Exception as e:
-        # Memory system error - continue silently
-        pass
+        # Could not create user - continue silently
+        get_memobase_health().record_failure()
+
+# Warm the memory context cache while the user is typing their question
+# (not on the polling reruns while an answer is written - that job has its context)
+if st.session_state.memobase_user and memobase_available() and not st.session_state.active_job:
+    get_memory_context_cache().prefetch(st.session_state.memobase_user)
+
+get_metrics().observe_stage("session_setup", time.perf_counter() - script_run_started)
 
 # Main header with modern styling
 st.markdown("""
@@ -624,12 +2935,18 @@ with col1:
     
     with type_col:
         # MBTI type selection with better styling
+        stored_personality = (browser_storage_values or {}).get("personality")
         selected_mbti = st.selectbox(
             "Personality type:",
             options=MBTI_TYPES,
+            index=MBTI_TYPES.index(stored_personality) if stored_personality in MBTI_TYPES else 0,
             format_func=lambda x: f"{MBTI_EMOJIS[x]} {x}",
             help="Not sure about your type? Take a free test online!"
         )
+        # Only once the stored personality has been read - before that the
+        # selectbox shows the default and would overwrite it
+        if browser_storage_values is not None:
+            st.session_state.storage_writes["cognitype_personality"] = selected_mbti
     
     with name_col:
         # Name input field with localStorage integration
@@ -641,6 +2958,12 @@ with col1:
                 st.session_state.loaded_name = query_params.get("name", [""])[0]
             except:
                 st.session_state.loaded_name = ""
+        
+        # The storage bridge answers after the first run - fill in the stored name once
+        if browser_storage_values and not st.session_state.get('stored_name_applied'):
+            st.session_state.stored_name_applied = True
+            if not st.session_state.loaded_name:
+                st.session_state.loaded_name = browser_storage_values.get("name") or ""
             
         user_name = st.text_input(
             "Your name:",
@@ -655,15 +2978,8 @@ with col1:
             st.session_state.loaded_name = user_name
             # Update URL parameters to persist name
             if user_name.strip():
-                try:
-                    st.experimental_set_query_params(name=user_name)
-                except:
-                    pass  # Ignore if fails
-            st.markdown(f"""
-            <script>
-            saveNameToLocalStorage('{user_name}');
-            </script>
-            """, unsafe_allow_html=True)
+                update_query_params(name=user_name)
+                st.session_state.storage_writes["cognitype_user_name"] = user_name
     
     # Display selected MBTI description with custom styling
     if selected_mbti:
@@ -698,12 +3014,37 @@ with col2:
         key="question_input_stable"  # Use stable key to prevent clearing
     )
     
+    # Multi-turn mode sends earlier turns along so follow-up questions keep their context
+    multi_turn = st.checkbox(
+        "🔗 Continue the conversation",
+        help="Include your earlier questions and answers so you can ask follow-ups",
+        key="multi_turn"
+    )
+    
+    # Compare mode asks several personalities the same question side by side
+    compare_types = []
+    if st.checkbox(
+        "🔀 Compare personalities",
+        help="Ask the same question to several personality types at once",
+        key="compare_mode"
+    ):
+        compare_types = st.multiselect(
+            "Personalities to compare:",
+            options=MBTI_TYPES,
+            format_func=lambda x: f"{MBTI_EMOJIS[x]} {x}",
+            max_selections=COMPARE_MAX_TYPES,
+            key="compare_types"
+        )
+    
     # Submit and clear buttons with better layout
     col_submit, col_clear = st.columns([3, 1])
     
     with col_submit:
+        submit_label = f"🚀 Get {selected_mbti if selected_mbti else 'Personalized'} Response"
+        if compare_types:
+            submit_label = f"🚀 Compare {len(compare_types)} Personalities"
         submit_button = st.button(
-            f"🚀 Get {selected_mbti if selected_mbti else 'Personalized'} Response",
+            submit_label,
             type="primary",
             disabled=not selected_mbti,
             use_container_width=True
@@ -717,222 +3058,185 @@ with col2:
 
 # Handle clear button
 if clear_button:
-    st.session_state.conversation_history = []
+    st.session_state.conversation_history.clear()
+    st.session_state.save_jobs = {}
+    st.session_state.chat_summary_lines = []
+    st.session_state.chat_summarized_turns = 0
+    st.session_state.history_visible = HISTORY_PAGE_SIZE
+    st.session_state.active_job = None
+    save_chat_state(overwrite=True)
     st.rerun()
 
 # Handle submit button with improved loading animation
 if submit_button and user_question.strip():
-    if selected_mbti:
-        # Use a fixed container to prevent page jumping
-        with st.container():
-            # Immediately show loading to provide instant feedback
-            loading_placeholder = st.empty()
-            loading_placeholder.markdown(f"""
-            <div class="loading-animation">
-                <div class="loading-dots">
-                    <div></div>
-                    <div></div>
-                    <div></div>
-                    <div></div>
-                </div>
-            </div>
-            <p style="text-align: center; margin-top: 1rem;">
-                🧠 Crafting a personalized {selected_mbti} response...
-            </p>
-            """, unsafe_allow_html=True)
-            
-            # Get memory context from Memobase if available (optimized for speed)
-            memory_context = ""
-            if st.session_state.memobase_user:
-                try:
-                    # Use faster Memobase context() with smaller token size
-                    memory_context = st.session_state.memobase_user.context(
-                        max_token_size=500,  # Reduced from 1000 for speed
-                        profile_event_ratio=0.5,  # Balanced ratio
-                        require_event_summary=False  # Skip summaries for speed
-                    )
-                    
-                    if memory_context and len(memory_context.strip()) > 0:
-                        memory_context = f"\n<user_memory>\n{memory_context}\n</user_memory>\n"
-                        # Update loading message to show memory usage
-                        loading_placeholder.markdown(f"""
-                        <div class="loading-animation">
-                            <div class="loading-dots">
-                                <div></div>
-                                <div></div>
-                                <div></div>
-                                <div></div>
-                            </div>
-                        </div>
-                        <p style="text-align: center; margin-top: 1rem;">
-                            🧠 Crafting a personalized {selected_mbti} response + using your memory...
-                        </p>
-                        """, unsafe_allow_html=True)
-                    else:
-                        memory_context = ""
-                        
-                except Exception as e:
-                    # If memory fails, continue without it for speed
-                    memory_context = ""
-            
-            # Create personalized prompt with memory
-            prompt = create_personalized_prompt(selected_mbti, user_question, memory_context)
-            
-            # Get API key
-            api_key = get_api_key()
-            
-            # Make API call
-            response = call_together_api(prompt, api_key)
-            
-            # Clear loading animation
-            loading_placeholder.empty()
-            
-            # Store in conversation history with timestamp
-            st.session_state.conversation_history.append({
-                'mbti_type': selected_mbti,
-                'question': user_question,
-                'response': response,
-                'timestamp': datetime.now().strftime("%H:%M")
-            })
-            
-            # Prevent page jumping with JavaScript
-            st.markdown("""
-            <script>
-            // Keep scroll position stable
-            window.scrollTo({top: window.scrollY, behavior: 'instant'});
-            </script>
-            """, unsafe_allow_html=True)
-    else:
+    if not selected_mbti:
         st.error("🎯 Please select your personality type first!")
+    elif st.session_state.active_job:
+        st.info("⏳ Still answering your last question - hang on a moment!")
+    else:
+        # Start the memory fetch first so it overlaps with the rest of the preparation
+        submit_started = time.time()
+        memory_future = None
+        if st.session_state.memobase_user and memobase_available():
+            memory_future = get_memory_context_cache().prefetch(st.session_state.memobase_user)
+        
+        # Get API key
+        api_key = get_api_key()
+        
+        # Earlier turns for follow-up questions
+        chat_context = None
+        if multi_turn:
+            chat_context = build_chat_context(st.session_state.conversation_history, st.session_state)
+        
+        # Answer on the shared worker pool; only the job id is kept in the session
+        mbti_types = compare_types or [selected_mbti]
+        user_id = get_session_user_id()
+        try:
+            job_id = get_inference_jobs().submit(
+                lambda job_id: answer_question(
+                    job_id, mbti_types, user_question, memory_future, submit_started, api_key,
+                    user_id=user_id, chat_context=chat_context
+                )
+            )
+            st.session_state.active_job = {
+                'id': job_id,
+                'mbti_types': mbti_types,
+                'question': user_question,
+                'submitted': submit_started
+            }
+        except queue.Full:
+            st.error("😵 The server is busy right now. Please try again in a moment.")
+
+# Follow the question being answered - it survives reruns, so clicks don't lose the answer
+if st.session_state.active_job:
+    active_job = st.session_state.active_job
+    
+    # Use a fixed container to prevent page jumping
+    with st.container():
+        active_job_panel = inference_job_panel(active_job)
+        active_job_snapshot = render_inference_job(active_job, active_job_panel)
+    job = active_job_snapshot
+    
+    if job is None:
+        st.session_state.active_job = None
+        st.error("❌ Your answer was lost (the server may have restarted). Please ask again.")
+    elif job['status'] == "done":
+        st.session_state.active_job = None
+        # Store in conversation history with timestamp
+        for mbti_type in active_job['mbti_types']:
+            response = job['answers'].get(mbti_type)
+            if response is None:
+                # The job crashed - its message says why
+                response = job['message'] if job['message'].startswith("Error:") else \
+                    "Error: No response content received from the API."
+            st.session_state.conversation_history.append(
+                ConversationTurn(mbti_type, active_job['question'], response)
+            )
+        save_chat_state()
+        get_metrics().observe_stage("submit_total", time.time() - active_job['submitted'])
+        
+        # Prevent page jumping with JavaScript
+        st.markdown("""
+        <script>
+        // Keep scroll position stable
+        window.scrollTo({top: window.scrollY, behavior: 'instant'});
+        </script>
+        """, unsafe_allow_html=True)
 
 # Display conversation history with improved styling
+history_render_started = time.perf_counter()
 if st.session_state.conversation_history:
     st.markdown("### 💬 Chat History")
     
-    for i, conversation in enumerate(reversed(st.session_state.conversation_history)):
-        timestamp = conversation.get('timestamp', 'Unknown time')
-        conversation_index = len(st.session_state.conversation_history) - 1 - i
+    # Only the newest page(s) are rendered, so a rerun costs the same however long the chat gets
+    history = st.session_state.conversation_history
+    oldest_visible = max(len(history) - st.session_state.history_visible, history.first)
+    
+    for conversation_index in range(len(history) - 1, oldest_visible - 1, -1):
+        conversation = history[conversation_index]
+        user_html, ai_html = conversation_html(conversation)
         
         # Create container with save button next to user message header
         user_col1, user_col2 = st.columns([9, 2])  # Give more space to save button
         
         with user_col1:
-            st.markdown(f"""
-            <div class="chat-message user-message">
-                <strong>💬 You ({conversation['mbti_type']}) - {timestamp}</strong><br>
-                {conversation['question']}
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(user_html, unsafe_allow_html=True)
         
         with user_col2:
             # Save button next to user message - improved layout
             st.markdown('<div style="padding-top: 0.5rem;"></div>', unsafe_allow_html=True)  # Add some top padding
+            
+            # Saves run on a background queue - show the status of this conversation's save
+            save_status = None
+            save_job_id = st.session_state.save_jobs.get(conversation_index)
+            if save_job_id and st.session_state.memobase_client:
+                save_status = get_memory_save_queue().status(save_job_id)
+            save_labels = {"queued": "⏳ Saving", "saved": "✅ Saved", "failed": "💾 Retry"}
+            
             if st.button(
-                "💾 Save",
+                save_labels.get(save_status, "💾 Save"),
                 help="Save this conversation to memory",
-                disabled=not st.session_state.memobase_user,
+                disabled=not st.session_state.memobase_user or save_status in ("queued", "saved"),
                 key=f"save_conv_{conversation_index}",
                 use_container_width=True
             ):
                 if st.session_state.memobase_user:
                     try:
-                        # Save using proper ChatBlob format according to Memobase docs
-                        from memobase import ChatBlob
-                        
-                        # Create ChatBlob with proper message format
-                        chat_blob = ChatBlob(messages=[
+                        # Proper ChatBlob message format according to Memobase docs
+                        messages = [
                             {
                                 "role": "user",
-                                "content": conversation['question']
+                                "content": conversation.question
                             },
                             {
                                 "role": "assistant", 
-                                "content": conversation['response']
+                                "content": conversation.response
                             }
-                        ])
-                        
-                        # Insert the chat blob
-                        blob_id = st.session_state.memobase_user.insert(chat_blob)
+                        ]
                         
-                        # Flush to trigger memory extraction (profiles and events)
-                        st.session_state.memobase_user.flush()
-                        
-                        # Use container to prevent page jumping
-                        with st.container():
-                            st.success("💾 Conversation saved to memory!")
+                        # Insert and flush happen on the background worker
+                        save_queue = get_memory_save_queue()
+                        st.session_state.save_jobs[conversation_index] = save_queue.enqueue(
+                            st.session_state.memobase_user.user_id, messages
+                        )
+                        st.rerun()
                         
+                    except queue.Full:
+                        st.warning("⚠️ Too many saves in progress - please try again in a moment")
                     except Exception as e:
                         st.error(f"❌ Failed to save: {str(e)}")
                 else:
                     st.warning("⚠️ Memory service not available")
         
         # Display AI response
-        if conversation['response'].startswith("Error:"):
-            st.markdown(f"""
-            <div class="chat-message" style="border-left: 4px solid #e53e3e; background: #fed7d7;">
-                <strong>🤖 AI Assistant</strong><br>
-                {conversation['response']}
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="chat-message ai-message">
-                <strong>🤖 {conversation['mbti_type']} Assistant</strong><br>
-                {conversation['response']}
-            </div>
-            """, unsafe_allow_html=True)
+        st.markdown(ai_html, unsafe_allow_html=True)
+    
+    if oldest_visible > history.first:
+        if st.button(
+            f"⬇️ Show earlier conversations ({oldest_visible - history.first} more)",
+            key="show_earlier_history",
+            use_container_width=True
+        ):
+            st.session_state.history_visible += HISTORY_PAGE_SIZE
+            st.rerun()
+get_metrics().observe_stage("history_render", time.perf_counter() - history_render_started)
 
 # Footer with better styling
 st.markdown("---")
 st.markdown("""
-<div style='text-align: center; padding: 2rem; margin-top: 2rem;'>
-    <p style='color: #666; font-size: 1.1rem; margin: 0; font-weight: 500;'>
-        ✨ Built with love using Streamlit • Powered by Together.ai & Mistral-7B ✨
-    </p>
-    <p style='color: #888; font-size: 0.9rem; margin: 0.5rem 0 0 0;'>
-        🧠 Making AI conversations more personal, one type at a time
-    </p>
+<div class="app-footer">
+    <p class="app-footer-title">✨ Built with love using Streamlit • Powered by Together.ai & Mistral-7B ✨</p>
+    <p class="app-footer-subtitle">🧠 Making AI conversations more personal, one type at a time</p>
 </div>
 """, unsafe_allow_html=True)
 
-# Load persistent data from localStorage on page load
-if 'data_loaded_from_storage' not in st.session_state:
-    st.session_state.data_loaded_from_storage = True
-    
-    # Initialize a way to check if we have localStorage data
-    st.markdown("""
-    <script>
-    // Check for existing user data in localStorage
-    const savedName = getNameFromLocalStorage();
-    const savedUserId = getUserIdFromLocalStorage();
-    const savedMemobaseUid = getMemobaseUserIdFromLocalStorage();
-    const currentMemobaseUid = localStorage.getItem('cognitype_current_memobase_uid');
-    
-    // Create hidden elements to communicate with Python
-    if (savedName || savedUserId || savedMemobaseUid || currentMemobaseUid) {
-        const dataDiv = document.createElement('div');
-        dataDiv.id = 'localStorage-data';
-        dataDiv.style.display = 'none';
-        if (savedName) dataDiv.setAttribute('data-name', savedName);
-        if (savedUserId) dataDiv.setAttribute('data-user-id', savedUserId);
-        if (savedMemobaseUid) dataDiv.setAttribute('data-memobase-uid', savedMemobaseUid);
-        if (currentMemobaseUid) dataDiv.setAttribute('data-current-memobase-uid', currentMemobaseUid);
-        document.body.appendChild(dataDiv);
-        
-        console.log('Found localStorage data:', {
-            name: savedName, 
-            userId: savedUserId, 
-            memobaseUid: savedMemobaseUid,
-            currentMemobaseUid: currentMemobaseUid
-        });
-        
-        // Store in Streamlit session for Python access
-        window.localStorage_data = {
-            name: savedName,
-            userId: savedUserId,
-            memobaseUid: savedMemobaseUid,
-            currentMemobaseUid: currentMemobaseUid
-        };
-    }
-    </script>
-    """, unsafe_allow_html=True)
+# Sync localStorage through the browser storage bridge: applies this run's
+# writes and reports the stored values (read at the top of the next run)
+browser_storage(writes=st.session_state.storage_writes)
+
+get_metrics().observe_stage("script_run", time.perf_counter() - script_run_started)
+
+# Still answering: update only the answer's panel until it is done, then rerun once to file it
+if st.session_state.active_job:
+    follow_inference_job(st.session_state.active_job, active_job_panel, active_job_snapshot)
+    st.rerun()
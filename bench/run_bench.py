@@ -0,0 +1,295 @@
+"""Load test for the chat pipeline
+
+Drives the real Streamlit script with AppTest: every simulated session
+loads the app, picks a personality type and submits questions through the
+normal submit path (prompt assembly -> memory fetch -> LLM call -> history
+append) against local stub servers for Together.ai and Memobase.
+
+    python bench/run_bench.py --sessions 20 --concurrency 5 --output results.json
+    python bench/run_bench.py --compare results.json   # fail on a p95 regression
+
+Sessions run in a pool of --concurrency worker processes, because AppTest
+can only run one script at a time per process. Each worker is like one
+server process: its sessions share the app's cached resources (HTTP pool,
+caches, traffic governor), while all workers share the stub servers.
+
+Results are printed and optionally saved as JSON so runs can be compared.
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from stubs import start_memobase_stub, start_together_stub
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+QUESTIONS = [
+    "What careers would suit me?",
+    "How do I handle conflict at work?",
+    "How can I make new friends in a new city?",
+    "What is a good way to learn a new language?",
+    "How do I stay motivated on long projects?",
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def read_stage_means(paths):
+    """Mean milliseconds per stage from the workers' Prometheus metrics files"""
+    sums, counts = {}, {}
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            if not line.startswith("cognitype_stage_seconds_"):
+                continue
+            name, value = line.rsplit(" ", 1)
+            stage = name.split('stage="', 1)[1].split('"', 1)[0]
+            if name.startswith("cognitype_stage_seconds_sum"):
+                sums[stage] = sums.get(stage, 0.0) + float(value)
+            elif name.startswith("cognitype_stage_seconds_count"):
+                counts[stage] = counts.get(stage, 0) + int(value)
+    return {
+        stage: round(sums[stage] / counts[stage] * 1000, 2)
+        for stage in sorted(sums) if counts.get(stage)
+    }
+
+
+def init_worker(workdir):
+    # One metrics file per worker process
+    os.environ["METRICS_FILE"] = os.path.join(workdir, f"metrics-{os.getpid()}.prom")
+    # Like `streamlit run`, let the app import its sibling modules
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+
+
+def run_session(session_index, args):
+    """One simulated user: load the page, then ask questions one after another
+
+    Returns the submit latencies in seconds, the number of failed submits
+    and how much the worker's memory grew while the session was alive.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    # AppTest swaps out __main__ while a script runs; the pool needs it to find this function
+    main_module = sys.modules["__main__"]
+    try:
+        return simulate_user(AppTest.from_file(APP_PATH, default_timeout=args.timeout), session_index, args)
+    finally:
+        sys.modules["__main__"] = main_module
+
+
+def simulate_user(app, session_index, args):
+    memory_before = current_rss_kb()
+    latencies = []
+    errors = 0
+    type_index = session_index % 16
+
+    def run(click=None):
+        """One script run; False when it ended in st.rerun()"""
+        # The personality selectbox has to be re-selected before every AppTest run
+        if app.selectbox:
+            app.selectbox[0].select_index(type_index)
+        if click is not None:
+            click.click()
+        try:
+            app.run()
+        except KeyError:
+            # AppTest can't finish a run that ended in st.rerun() and leaves its page tree
+            # stale; the next run (as the browser would do) renders the whole page again
+            return False
+        return True
+
+    app.run()
+    # Second run: the browser storage bridge has "answered" and the user id exists
+    run()
+    # Third run: the submit button is labelled with the chosen type
+    run()
+
+    for question_index in range(args.questions):
+        question = QUESTIONS[(session_index + question_index) % len(QUESTIONS)]
+        if args.unique_questions:
+            question = f"{question} (session {session_index}, question {question_index})"
+
+        app.text_area[0].input(question)
+        started = time.perf_counter()
+        complete = run(click=app.button[0])
+        # The page reruns itself while the answer is being written
+        while (not complete or app.session_state["active_job"] or not app.text_area) and \
+                time.perf_counter() - started < args.timeout:
+            complete = run()
+        elapsed = time.perf_counter() - started
+
+        answered = any("ai-message" in markdown.value for markdown in app.markdown)
+        if app.exception or not answered:
+            errors += 1
+        else:
+            latencies.append(elapsed)
+    return latencies, errors, current_rss_kb() - memory_before
+
+
+def current_rss_kb():
+    """Resident memory of this process (peak RSS where /proc isn't available)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(APP_PATH), check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(result, baseline_path, max_regression):
+    """Print the change against a saved run; True when p95 latency regressed too much"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    print(f"\nCompared with {baseline_path} ({baseline.get('commit')}):")
+    for key in ("p50", "p95", "p99"):
+        before = baseline["latency_ms"][key]
+        after = result["latency_ms"][key]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"  {key}: {before:.1f} ms -> {after:.1f} ms ({change:+.1f}%)")
+    before = baseline["throughput_rps"]
+    after = result["throughput_rps"]
+    print(f"  throughput: {before:.2f} -> {after:.2f} req/s")
+
+    p95_before = baseline["latency_ms"]["p95"]
+    return bool(p95_before) and result["latency_ms"]["p95"] > p95_before * (1 + max_regression / 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=10, help="simulated user sessions")
+    parser.add_argument("--concurrency", type=int, default=4, help="sessions running at the same time")
+    parser.add_argument("--questions", type=int, default=3, help="questions asked per session")
+    parser.add_argument("--backend", choices=["stub", "fake"], default="stub",
+                        help="stub: HTTP stub server for Together.ai; fake: the app's in-process fake backend")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=200, help="LLM token rate")
+    parser.add_argument("--response-tokens", type=int, default=80, help="tokens per answer")
+    parser.add_argument("--memory-latency", type=float, default=0.05, help="Memobase context() latency")
+    parser.add_argument("--no-memory", action="store_true", help="run without Memobase")
+    parser.add_argument("--unique-questions", action="store_true",
+                        help="make every question unique so no cache can answer it")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds allowed per script run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--max-regression", type=float, default=20,
+                        help="with --compare: exit 1 when p95 is this many percent slower")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="cognitype-bench-")
+    together = None
+    memobase = None
+
+    os.environ.update({
+        "SAVE_SPOOL_DIR": os.path.join(workdir, "save_spool"),
+        "RESPONSE_CACHE_PATH": os.path.join(workdir, "responses.sqlite3"),
+        "METRICS_FILE_INTERVAL": "0.5",
+        # Each simulated session is a single user, so don't let per-user rate limits skew latency
+        "LLM_RATE_PER_MINUTE": os.environ.get("LLM_RATE_PER_MINUTE", "100000"),
+        "LLM_RATE_BURST": os.environ.get("LLM_RATE_BURST", "1000"),
+    })
+    if args.backend == "stub":
+        together = start_together_stub(args.llm_latency, args.tokens_per_sec, args.response_tokens)
+        os.environ.update({
+            "LLM_BACKEND": "together",
+            "TOGETHER_API_URL": f"{together.url}/v1/chat/completions",
+            "TOGETHER_API_KEY": "bench",
+        })
+    else:
+        os.environ.update({
+            "LLM_BACKEND": "fake",
+            "FAKE_LLM_LATENCY": str(args.llm_latency),
+            "FAKE_LLM_TOKENS_PER_SEC": str(args.tokens_per_sec),
+            "FAKE_LLM_RESPONSE_TOKENS": str(args.response_tokens),
+        })
+    if args.no_memory:
+        os.environ["MEMOBASE_API_KEY"] = ""
+    else:
+        memobase = start_memobase_stub(args.memory_latency)
+        os.environ.update({"MEMOBASE_URL": memobase.url, "MEMOBASE_API_KEY": "bench"})
+
+    latencies = []
+    errors = 0
+    session_memory = []
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.concurrency, initializer=init_worker,
+                             initargs=(workdir,)) as executor:
+        futures = [executor.submit(run_session, i, args) for i in range(args.sessions)]
+        for future in futures:
+            try:
+                session_latencies, session_errors, memory_growth = future.result()
+            except Exception as e:
+                print(f"session failed: {e!r}", file=sys.stderr)
+                errors += args.questions
+                continue
+            latencies.extend(session_latencies)
+            errors += session_errors
+            session_memory.append(memory_growth)
+        duration = time.perf_counter() - started
+        time.sleep(1.0)  # let the workers write their metrics files once more
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "submits": len(latencies),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 3) if duration else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            "p95": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            "p99": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+            "max": round(max(latencies) * 1000, 2) if latencies else None,
+        },
+        "memory_per_session_kb": round(sum(session_memory) / len(session_memory), 1) if session_memory else None,
+        "peak_worker_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "upstream_requests": {
+            "together": together.requests if together else None,
+            "memobase": memobase.requests if memobase else None,
+        },
+        "stage_mean_ms": read_stage_means(glob.glob(os.path.join(workdir, "metrics-*.prom"))),
+    }
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare and result["latency_ms"]["p95"] is not None:
+        if compare(result, args.compare, args.max_regression):
+            print(f"p95 latency regressed by more than {args.max_regression}%", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Local stub servers for Together.ai and Memobase used by the benchmarks
+
+Both servers run on daemon threads on 127.0.0.1 with a random free port and
+simulate the latency of the real services, so the benchmark measures the
+app's own overhead on top of a known, repeatable upstream.
+"""
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Worker processes exiting with keep-alive connections open is expected
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class StubServer:
+    """A running stub server with request counters"""
+
+    def __init__(self, handler_class, **settings):
+        self.requests = 0
+        self.settings = settings
+        self.state = {}
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(handler_class):
+            server_stub = stub
+
+        self.server = QuietHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TogetherHandler(JSONHandler):
+    """OpenAI-style chat completions, streamed as server-sent events when asked"""
+
+    def do_POST(self):
+        stub = self.server_stub
+        stub.count()
+        payload = self.read_json()
+        settings = stub.settings
+
+        words = [f"word{i % 17}" for i in range(settings["response_tokens"])]
+        delay = 1 / settings["tokens_per_sec"] if settings["tokens_per_sec"] > 0 else 0
+        time.sleep(settings["latency"])
+
+        if not payload.get("stream"):
+            time.sleep(delay * len(words))
+            self.send_json({"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write_chunk(data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        for i, word in enumerate(words):
+            time.sleep(delay)
+            text = word if i == 0 else " " + word
+            event = {"choices": [{"delta": {"content": text}}]}
+            write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        write_chunk(b"data: [DONE]\n\n")
+        write_chunk(b"")
+
+
+class MemobaseHandler(JSONHandler):
+    """The subset of the Memobase API the app uses: users, context, blob insert and flush"""
+
+    def respond(self, data=None, errno=0, errmsg=""):
+        self.send_json({"data": data, "errno": errno, "errmsg": errmsg})
+
+    def do_GET(self):
+        stub = self.server_stub
+        stub.count()
+        users = stub.state.setdefault("users", {})
+        path = self.path.split("?")[0]
+
+        if path.endswith("/healthcheck"):
+            return self.respond({})
+
+        match = re.match(r".*/users/context/(.+)", path)
+        if match:
+            time.sleep(stub.settings["context_latency"])
+            user = users.get(match.group(1))
+            if user is None:
+                return self.respond(None, 404, "user not found")
+            return self.respond({"context": "\n".join(user["blobs"][-20:])})
+
+        match = re.match(r".*/users/(.+)", path)
+        if match:
+            user = users.get(match.group(1))
+            if user is None:
+                return self.respond(None, 404, "user not found")
+            return self.respond({"data": user["data"]})
+
+        self.respond(None, 404, "not found")
+
+    def do_POST(self):
+        stub = self.server_stub
+        stub.count()
+        users = stub.state.setdefault("users", {})
+        payload = self.read_json()
+        path = self.path.split("?")[0]
+
+        if path.endswith("/users"):
+            user_id = payload.get("id") or str(uuid.uuid4())
+            users[user_id] = {"data": payload.get("data"), "blobs": []}
+            return self.respond({"id": user_id})
+
+        match = re.match(r".*/blobs/insert/(.+)", path)
+        if match:
+            user = users.setdefault(match.group(1), {"data": None, "blobs": []})
+            user["blobs"].append(json.dumps(payload.get("blob_data", payload))[:200])
+            return self.respond({"id": str(uuid.uuid4())})
+
+        if "/users/buffer/" in path:
+            time.sleep(stub.settings["flush_latency"])
+            return self.respond({})
+
+        self.respond(None, 404, "not found")
+
+
+def start_together_stub(latency=0.5, tokens_per_sec=50, response_tokens=120):
+    """Start a stub chat completions server (latency before the first token, then a steady token rate)"""
+    return StubServer(TogetherHandler, latency=latency, tokens_per_sec=tokens_per_sec,
+                      response_tokens=response_tokens)
+
+
+def start_memobase_stub(context_latency=0.05, flush_latency=0.2):
+    """Start a stub Memobase server"""
+    return StubServer(MemobaseHandler, context_latency=context_latency, flush_latency=flush_latency)
@@ -0,0 +1,134 @@
+"""Pick the similarity threshold for the semantic cache
+
+Scores labelled question pairs with the same embedder the app uses and
+prints precision and recall of a cache hit for a range of thresholds. A
+false hit serves someone an answer to a different question, so the
+recommended threshold is the one with the best recall whose precision is
+at least --min-precision.
+
+    python bench/tune_semantic_cache.py
+    python bench/tune_semantic_cache.py --model all-MiniLM-L6-v2
+    python bench/tune_semantic_cache.py --pairs pairs.jsonl --min-precision 0.98
+
+A pairs file has one JSON object per line: {"a": ..., "b": ..., "same": true}.
+Without one, a small built-in set of questions like the app gets is used.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_cache import create_embedder  # noqa: E402
+
+# (question, question, same meaning)
+PAIRS = [
+    ("What careers would suit me?", "Which careers suit me?", True),
+    ("What careers would suit me?", "what careers would suit me", True),
+    ("best jobs for INTJ", "What are the best jobs for an INTJ?", True),
+    ("best jobs for INTJ", "what careers fit an INTJ", True),
+    ("How do I handle conflict at work?", "How should I handle conflicts at work?", True),
+    ("How do I handle conflict at work?", "Tips for dealing with conflict at work", True),
+    ("How can I make new friends in a new city?", "How do I make friends after moving to a new city?", True),
+    ("How can I make new friends in a new city?", "making new friends in a new city", True),
+    ("What is a good way to learn a new language?", "What's the best way to learn a new language?", True),
+    ("How do I stay motivated on long projects?", "How can I stay motivated during long projects?", True),
+    ("How do I stay motivated on long projects?", "staying motivated on a long project", True),
+    ("How do I deal with stress?", "How can I deal with stress better?", True),
+    ("Am I a good leader?", "Would I be a good leader?", True),
+    ("How do I recharge after a busy week?", "How should I recharge after a busy week?", True),
+    ("What hobbies would I enjoy?", "Which hobbies would I enjoy most?", True),
+    ("How do I get better at public speaking?", "How can I improve my public speaking?", True),
+    ("What careers would suit me?", "What hobbies would I enjoy?", False),
+    ("What careers would suit me?", "What careers would suit my partner?", False),
+    ("best jobs for INTJ", "worst jobs for INTJ", False),
+    ("How do I handle conflict at work?", "How do I handle conflict with my family?", False),
+    ("How do I handle conflict at work?", "How do I ask for a raise at work?", False),
+    ("How can I make new friends in a new city?", "How can I keep old friends after moving?", False),
+    ("What is a good way to learn a new language?", "What is a good way to learn to code?", False),
+    ("How do I stay motivated on long projects?", "How do I stay focused in long meetings?", False),
+    ("How do I deal with stress?", "How do I deal with boredom?", False),
+    ("Am I a good leader?", "Am I a good listener?", False),
+    ("How do I recharge after a busy week?", "How do I plan a busy week?", False),
+    ("What hobbies would I enjoy?", "What hobbies would my kids enjoy?", False),
+    ("How do I get better at public speaking?", "How do I get better at writing?", False),
+    ("Should I start my own business?", "Should I quit my job?", False),
+    ("How do I say no to people?", "How do I say sorry to people?", False),
+    ("What kind of partner suits me?", "What kind of manager suits me?", False),
+    ("Why do INTJs avoid conflict?", "How do INTJs avoid conflict?", False),
+    ("When should I quit my job?", "Why should I quit my job?", False),
+    ("Should I move abroad?", "How could I move abroad?", False),
+    ("Where should I live?", "Who should I live with?", False),
+    ("Can I change my personality?", "Should I change my personality?", False),
+]
+
+
+def load_pairs(path):
+    pairs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                pair = json.loads(line)
+                pairs.append((pair["a"], pair["b"], bool(pair["same"])))
+    return pairs
+
+
+def score(embedder, pairs):
+    """Cosine similarity and label of every pair"""
+    return [(float(embedder.embed(a) @ embedder.embed(b)), same) for a, b, same in pairs]
+
+
+def sweep(scored, thresholds):
+    """Precision and recall of a cache hit (similarity >= threshold) at each threshold"""
+    rows = []
+    for threshold in thresholds:
+        true_hits = sum(1 for similarity, same in scored if similarity >= threshold and same)
+        false_hits = sum(1 for similarity, same in scored if similarity >= threshold and not same)
+        duplicates = sum(1 for _, same in scored if same)
+        precision = true_hits / (true_hits + false_hits) if true_hits + false_hits else 1.0
+        recall = true_hits / duplicates if duplicates else 0.0
+        rows.append((threshold, precision, recall, false_hits))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", help="JSON lines file of labelled question pairs")
+    parser.add_argument("--model", default=os.getenv("SEMANTIC_CACHE_MODEL", ""),
+                        help="sentence-transformers model (default: the hashed n-gram embedder)")
+    parser.add_argument("--dim", type=int, default=int(os.getenv("SEMANTIC_CACHE_DIM", "1024")),
+                        help="vector size of the hashed n-gram embedder")
+    parser.add_argument("--min-precision", type=float, default=0.95,
+                        help="lowest acceptable share of cache hits that are real duplicates")
+    parser.add_argument("--show-pairs", action="store_true", help="print the similarity of every pair")
+    args = parser.parse_args()
+
+    pairs = load_pairs(args.pairs) if args.pairs else PAIRS
+    embedder = create_embedder(args.model, args.dim)
+    if args.model and embedder.name != args.model:
+        print(f"could not load {args.model}, using the hashed n-gram embedder", file=sys.stderr)
+    scored = score(embedder, pairs)
+
+    if args.show_pairs:
+        for (a, b, same), (similarity, _) in sorted(zip(pairs, scored), key=lambda item: -item[1][0]):
+            print(f"{similarity:.3f} {'same' if same else 'diff'}  {a!r} / {b!r}")
+        print()
+
+    rows = sweep(scored, [round(0.5 + i * 0.01, 2) for i in range(50)])
+    print(f"embedder: {embedder.name}, {len(pairs)} pairs")
+    print("threshold  precision  recall  false hits")
+    for threshold, precision, recall, false_hits in rows:
+        print(f"     {threshold:.2f}      {precision:.3f}   {recall:.3f}  {false_hits:10d}")
+
+    acceptable = [row for row in rows if row[1] >= args.min_precision]
+    if not acceptable:
+        print(f"\nno threshold reaches a precision of {args.min_precision}")
+        sys.exit(1)
+    best = max(acceptable, key=lambda row: (row[2], -row[0]))
+    print(f"\nrecommended: SEMANTIC_CACHE_THRESHOLD={best[0]:.2f} "
+          f"(precision {best[1]:.3f}, recall {best[2]:.3f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Semantic cache: reuse the answer to a question that means the same as one asked before
+
+Questions are turned into unit vectors, either by a small sentence-transformers
+model running on the CPU (optional package) or by a hashed n-gram vectorizer
+that needs nothing but NumPy. The vectors of answered questions are kept in a
+NumPy matrix per scope; a lookup is a single matrix-vector product.
+
+Kept free of Streamlit so bench/tune_semantic_cache.py can use the same
+embedders as the app.
+"""
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+# Words that carry little meaning in a question; ignoring them lets "best jobs for an INTJ"
+# and "best INTJ jobs" land close together. Pronouns stay: "suit me" and "suit my partner" differ.
+# So do question words and modals: "why do INTJs avoid conflict" is not "how do INTJs avoid conflict".
+STOPWORDS = frozenset("""
+a about am an and any are as at be been being but by do does for from get had has have if in
+into is it its of on or so some than that the then there these this to was with
+""".split())
+
+# Two questions often differ only in the question word, so it weighs more than other words;
+# "which" asks the same as "what"
+QUESTION_WORDS = {"how": "how", "why": "why", "when": "when", "where": "where", "who": "who",
+                  "what": "what", "which": "what"}
+QUESTION_WORD_WEIGHT = 1.5
+
+
+class HashingEmbedder:
+    """Hashed word, word-pair and character trigram features (no model, pure NumPy)
+
+    Catches rewordings that share most of their words or word stems; true
+    paraphrases with different words ("jobs" vs "careers") need a real
+    embedding model.
+    """
+    name = "hashing"
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+
+    def features(self, text):
+        words = [QUESTION_WORDS.get(word, word) for word in re.findall(r"[a-z0-9']+", text.lower())
+                 if word not in STOPWORDS]
+        features = []
+        for word in words:
+            features.append(("w:" + word, QUESTION_WORD_WEIGHT if word in QUESTION_WORDS else 1.0))
+            padded = f"<{word}>"
+            features.extend(("c:" + padded[i:i + 3], 0.25) for i in range(len(padded) - 2))
+        features.extend((f"b:{first} {second}", 0.5) for first, second in zip(words, words[1:]))
+        return features
+
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, weight in self.features(text):
+            # crc32 instead of hash(): vectors must match across processes and restarts
+            digest = zlib.crc32(feature.encode("utf-8"))
+            vector[digest % self.dim] += weight if digest & 0x80000000 else -weight
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SentenceTransformerEmbedder:
+    """A sentence-transformers model on the CPU (e.g. all-MiniLM-L6-v2)"""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def embed(self, text):
+        return self.model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+
+def create_embedder(model_name="", dim=1024):
+    """The sentence-transformers model when one is named and loads, else the hashing embedder"""
+    if model_name:
+        try:
+            return SentenceTransformerEmbedder(model_name)
+        except Exception:
+            # Package missing or model unavailable - fall back rather than fail
+            pass
+    return HashingEmbedder(dim)
+
+
+class VectorIndex:
+    """Unit vectors of answered questions and their answers, grown as needed"""
+
+    def __init__(self, dim, capacity=16):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.created = np.zeros(capacity)
+        self.used = np.zeros(capacity)
+        self.answers = [None] * capacity
+        self.count = 0
+
+    def add(self, vector, answer, now, max_entries, ttl):
+        if self.count < max_entries:
+            if self.count == len(self.answers):
+                self._grow(min(len(self.answers) * 2, max_entries))
+            slot = self.count
+            self.count += 1
+        else:
+            # Full: replace an expired entry if there is one, else the least recently used
+            used = np.where(self.created < now - ttl, -np.inf, self.used)
+            slot = int(np.argmin(used))
+        self.vectors[slot] = vector
+        self.created[slot] = now
+        self.used[slot] = now
+        self.answers[slot] = answer
+
+    def _grow(self, capacity):
+        extra = capacity - len(self.answers)
+        self.vectors = np.vstack([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.created = np.concatenate([self.created, np.zeros(extra)])
+        self.used = np.concatenate([self.used, np.zeros(extra)])
+        self.answers.extend([None] * extra)
+
+
+class SemanticCache:
+    """Answers looked up by meaning instead of by exact prompt
+
+    Entries are grouped in scopes - only questions asked in the same scope
+    (for the app: one personality type under one model setup) can answer
+    each other. The closest stored question is a hit when its cosine
+    similarity reaches threshold. Entries expire after ttl seconds; a full
+    scope replaces its least recently used entry.
+    """
+
+    def __init__(self, embedder, threshold=0.9, max_entries=500, ttl=86400):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._scopes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, question):
+        return self.embedder.embed(question)
+
+    def get(self, scope, vector):
+        """The answer stored for the closest question in scope, or None below the threshold"""
+        now = time.time()
+        with self._lock:
+            index = self._scopes.get(scope)
+            if index is None or index.count == 0:
+                self.misses += 1
+                return None
+            similarities = index.vectors[:index.count] @ vector
+            similarities[index.created[:index.count] < now - self.ttl] = -1.0
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            index.used[best] = now
+            self.hits += 1
+            return index.answers[best]
+
+    def set(self, scope, vector, answer):
+        with self._lock:
+            index = self._scopes.get(scope)
+            if index is None:
+                index = self._scopes[scope] = VectorIndex(len(vector), min(16, self.max_entries))
+            index.add(vector, answer, time.time(), self.max_entries, self.ttl)
+
+    def stats(self):
+        """Hit/miss counters for monitoring"""
+        with self._lock:
+            entries = sum(index.count for index in self._scopes.values())
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "embedder": self.embedder.name}
+
+    def metric_samples(self):
+        """The stats as (metric, type, labels, value) samples for a Prometheus exposition"""
+        stats = self.stats()
+        labels = {"cache": "semantic"}
+        return [
+            ("cognitype_cache_hits_total", "counter", labels, stats["hits"]),
+            ("cognitype_cache_misses_total", "counter", labels, stats["misses"]),
+            ("cognitype_cache_entries", "gauge", labels, stats["entries"]),
+        ]